@@ -1,7 +1,392 @@
 from pypdf import PdfReader, PdfWriter
 from pypdf.generic import NameObject, TextStringObject, DictionaryObject, ArrayObject, NumberObject, IndirectObject
 
+import mmap
+import os
 import re
+import zlib
+
+from json_files import save_json_atomic
+
+# Куда analyze_pdf_directory пишет JSON-отчет по умолчанию
+ANALYSIS_REPORT_PATH = 'pdf_analysis.json'
+
+# Все признаки, которые ищет analyze_pdf_bytes, - одно регулярное выражение по байтам
+# файла. Массивы захватываются как [^\]]* - без возвратов, в отличие от /Btn\b.*?/Ff
+PDF_TOKEN_RE = re.compile(rb"""
+    (?P<obj>\d+)\s+\d+\s+obj\b\s*(?:\[(?P<obj_array>[^\]]*)\])?
+  | (?P<endobj>endobj)
+  | (?<![A-Za-z])(?P<stream>stream)(?:\r\n|\n|\r)
+  | /Type\s*/(?P<type>Catalog|Pages|Page|ObjStm|XRef)\b
+  | /Subtype\s*/(?P<widget>Widget)\b
+  | /FT\s*/(?P<ft>Tx|Btn|Ch|Sig)\b
+  | /Ff\s+(?P<ff>\d+)
+  | /T\s*(?P<name>[(<])
+  | /Parent\s+(?P<parent>\d+)\s+\d+\s+R
+  | /Kids\s*\[(?P<kids>[^\]]*)\]
+  | /Annots\s*(?:\[(?P<annots>[^\]]*)\]|(?P<annots_ref>\d+)\s+\d+\s+R)
+  | /Pages\s+(?P<pages_ref>\d+)\s+\d+\s+R
+  | /Root\s+(?P<root>\d+)\s+\d+\s+R
+  | /AcroForm\s*(?:(?P<acroform_ref>\d+)\s+\d+\s+R|(?P<acroform><<))
+  | /Fields\s*(?:\[(?P<fields>[^\]]*)\]|(?P<fields_ref>\d+)\s+\d+\s+R)
+  | /(?P<xfa>XFA)\b
+  | /NeedAppearances\s+(?P<need_appearances>true|false)
+  | /(?P<encrypt>Encrypt)\b
+  | /First\s+(?P<first>\d+)
+  | /Filter\s*(?P<filter>/\w+|\[[^\]]*\])
+  | /(?P<decode_parms>DecodeParms)\b
+""", re.VERBOSE)
+
+# Группы верхнего уровня PDF_TOKEN_RE в порядке проверки
+PDF_TOKENS = ('obj', 'endobj', 'stream', 'type', 'widget', 'ft', 'ff', 'name', 'parent', 'kids',
+              'annots', 'annots_ref', 'pages_ref', 'root', 'acroform_ref', 'acroform',
+              'fields', 'fields_ref', 'xfa', 'need_appearances', 'encrypt', 'first', 'filter',
+              'decode_parms')
+
+REF_RE = re.compile(rb'(\d+)\s+\d+\s+R')
+
+# Биты /Ff, различающие виды кнопок и списков
+FF_RADIO = 1 << 15
+FF_PUSHBUTTON = 1 << 16
+FF_COMBO = 1 << 17
+
+
+def _refs(array_bytes):
+    return [int(num) for num in REF_RE.findall(array_bytes)]
+
+
+def _match_token(match):
+    for token in PDF_TOKENS:
+        value = match.group(token)
+        if value is not None:
+            return token, value
+    return None, None
+
+
+def _record_token(current, token, value):
+    # Признак объекта из совпадения PDF_TOKEN_RE (кроме obj/endobj/stream)
+    if token in ('kids', 'annots', 'fields'):
+        current[token] = _refs(value)
+    elif token in ('parent', 'annots_ref', 'pages_ref', 'root', 'acroform_ref', 'fields_ref', 'ff', 'first'):
+        current[token] = int(value)
+    elif token in ('type', 'ft'):
+        current[token] = value.decode('ascii')
+    elif token == 'filter':
+        current[token] = value.strip(b'[] \t\r\n').decode('ascii', 'replace')
+    elif token == 'need_appearances':
+        current[token] = value == b'true'
+    else:
+        # widget, name, acroform, xfa, encrypt, decode_parms - флаги наличия
+        current[token] = True
+
+
+def _scan_object_stream(stream, data, objects):
+    """
+    Разбирает сжатые объекты потока /ObjStm: поток распаковывается zlib прямо
+    из среза data, по заголовку "номер смещение ..." каждый объект получает
+    признаки, найденные PDF_TOKEN_RE в своем теле.
+
+    Returns:
+        str: причина, по которой поток не разобран; None - разобран.
+    """
+    if stream.get('filter') != '/FlateDecode' or stream.get('decode_parms'):
+        return f"фильтр {stream.get('filter')} не поддерживается"
+    try:
+        # decompressobj, а не decompress: байты после конца zlib-потока (EOL перед endstream) игнорируются
+        body = zlib.decompressobj().decompress(data[stream['start']:stream['end']])
+        first = stream['first']
+        header = [int(number) for number in body[:first].split()]
+    except Exception as e:
+        return f"поток не распакован: {e}"
+    offsets = list(zip(header[0::2], header[1::2]))
+    for index, (num, offset) in enumerate(offsets):
+        end = first + offsets[index + 1][1] if index + 1 < len(offsets) else len(body)
+        current = objects[num] = {}
+        for match in PDF_TOKEN_RE.finditer(body, first + offset, end):
+            token, value = _match_token(match)
+            if token not in ('obj', 'endobj', 'stream'):
+                _record_token(current, token, value)
+    return None
+
+
+def scan_pdf_objects(data):
+    """
+    Один проход по байтам PDF (bytes или mmap, без декодирования и копирования
+    файла): для каждого объекта "N 0 obj ... endobj" собираются найденные в нем
+    признаки. Содержимое потоков (stream ... endstream) пропускается, кроме
+    потоков /ObjStm: сжатые в них объекты распаковываются и разбираются так же.
+    Объект, повторенный в инкрементальном обновлении, заменяет прежнюю версию.
+    Поток /ObjStm, который не удалось разобрать, получает признак 'objstm_error'.
+
+    Returns:
+        tuple: (объекты {номер: признаки}, признаки вне объектов - trailer)
+    """
+    objects = {}
+    trailer = {}
+    current = trailer
+    pos = 0
+    while True:
+        match = PDF_TOKEN_RE.search(data, pos)
+        if match is None:
+            break
+        pos = match.end()
+        token, value = _match_token(match)
+        
+        if token == 'obj':
+            current = objects[int(value)] = {}
+            if match.group('obj_array') is not None:
+                current['array'] = _refs(match.group('obj_array'))
+        elif token == 'endobj':
+            current = trailer
+        elif token == 'stream':
+            # Содержимое потока не разбираем: переходим сразу за endstream
+            end = data.find(b'endstream', pos)
+            end = len(data) if end < 0 else end
+            if current.get('type') == 'ObjStm':
+                error = _scan_object_stream(dict(current, start=pos, end=end), data, objects)
+                if error:
+                    current['objstm_error'] = error
+            pos = end + len(b'endstream')
+        else:
+            _record_token(current, token, value)
+    return objects, trailer
+
+
+def _inherited(objects, num, key):
+    # Значение атрибута поля с учетом наследования от родителей (/Parent)
+    seen = set()
+    while num is not None and num not in seen:
+        seen.add(num)
+        obj = objects.get(num, {})
+        if key in obj:
+            return obj[key]
+        num = obj.get('parent')
+    return None
+
+
+def field_kind(field_type, flags):
+    """
+    Вид поля по /FT и /Ff: text, checkbox, radio, pushbutton, combo, list, signature
+    """
+    flags = flags or 0
+    if field_type == 'Tx':
+        return 'text'
+    if field_type == 'Btn':
+        if flags & FF_PUSHBUTTON:
+            return 'pushbutton'
+        return 'radio' if flags & FF_RADIO else 'checkbox'
+    if field_type == 'Ch':
+        return 'combo' if flags & FF_COMBO else 'list'
+    if field_type == 'Sig':
+        return 'signature'
+    return 'unknown'
+
+
+def _page_order(objects, pages_root):
+    # Порядок страниц - обход дерева /Pages по /Kids
+    order = []
+    stack = [pages_root] if pages_root is not None else []
+    seen = set()
+    while stack:
+        num = stack.pop()
+        if num in seen:
+            continue
+        seen.add(num)
+        obj = objects.get(num, {})
+        if obj.get('type') == 'Pages' or ('kids' in obj and obj.get('type') != 'Page'):
+            stack.extend(reversed(obj.get('kids', [])))
+        elif obj:
+            order.append(num)
+    if not order:
+        # Дерево страниц не найдено (например, в сжатых объектах) - порядок объектов в файле
+        order = [num for num, obj in objects.items() if obj.get('type') == 'Page']
+    return order
+
+
+def analyze_pdf_bytes(data):
+    """
+    Анализ формы в PDF по байтам файла за один проход (см. scan_pdf_objects):
+    наличие AcroForm и XFA, число полей по видам и по страницам, признаки
+    поврежденной AcroForm. Если какой-то поток /ObjStm не разобран (например,
+    файл зашифрован), структура неизвестна: 'analyzed' = False, а страницы,
+    AcroForm и поля - None вместо неверных нулей.
+
+    Returns:
+        dict: отчет по файлу (сериализуется в JSON).
+    """
+    objects, trailer = scan_pdf_objects(data)
+    
+    object_streams = sum(1 for obj in objects.values() if obj.get('type') == 'ObjStm')
+    unread_streams = [obj['objstm_error'] for obj in objects.values() if 'objstm_error' in obj]
+    encrypted = trailer.get('encrypt') or any(obj.get('encrypt') for obj in objects.values() if obj.get('type') == 'XRef')
+    notes = []
+    if encrypted:
+        notes.append("файл зашифрован: строки и потоки не читаются")
+    if unread_streams:
+        notes.append(f"{len(unread_streams)} из {object_streams} потоков /ObjStm не разобраны ({unread_streams[0]}): "
+                     "структура формы неизвестна")
+        return {
+            'size': len(data),
+            'analyzed': False,
+            'objects': len(objects),
+            'object_streams': object_streams,
+            'pages': None,
+            'acroform': None,
+            'xfa': None,
+            'need_appearances': None,
+            'widgets': None,
+            'fields': None,
+            'fields_by_page': None,
+            'unlisted_fields': None,
+            'symptoms': [],
+            'notes': notes,
+        }
+        
+    root = trailer.get('root')
+    if root is None:
+        # Cross-reference stream: /Root лежит в словаре объекта /XRef
+        root = next((obj['root'] for obj in objects.values() if 'root' in obj), None)
+    catalog = objects.get(root) or next((obj for obj in objects.values() if obj.get('type') == 'Catalog'), {})
+    
+    # Словарь AcroForm - отдельный объект или вложен в каталог
+    acroform = {}
+    if 'acroform_ref' in catalog:
+        acroform = objects.get(catalog['acroform_ref'], {})
+    elif catalog.get('acroform'):
+        acroform = catalog
+    has_acroform = 'acroform_ref' in catalog or bool(catalog.get('acroform'))
+    listed_fields = acroform.get('fields')
+    if listed_fields is None and 'fields_ref' in acroform:
+        listed_fields = objects.get(acroform['fields_ref'], {}).get('array')
+        
+    pages = _page_order(objects, catalog.get('pages_ref'))
+    
+    # Виджеты по страницам
+    widgets = {num for num, obj in objects.items() if obj.get('widget')}
+    placed = set()
+    pages_report = []
+    for page_index, page_num in enumerate(pages, start=1):
+        page = objects.get(page_num, {})
+        annots = page.get('annots')
+        if annots is None and 'annots_ref' in page:
+            annots = objects.get(page['annots_ref'], {}).get('array', [])
+        by_type = {}
+        for annot in annots or ():
+            if annot not in widgets:
+                continue
+            placed.add(annot)
+            kind = field_kind(_inherited(objects, annot, 'ft'), _inherited(objects, annot, 'ff'))
+            by_type[kind] = by_type.get(kind, 0) + 1
+        if by_type:
+            pages_report.append({'page': page_index, 'widgets': sum(by_type.values()), 'by_type': by_type})
+            
+    # Поля: виджет с /T - сам поле, без /T - часть поля-родителя (например, вариант переключателя)
+    fields = {}
+    untyped = 0
+    for num in widgets:
+        obj = objects[num]
+        field = num if obj.get('name') or 'parent' not in obj else obj['parent']
+        field_type = _inherited(objects, num, 'ft')
+        if field_type is None:
+            untyped += 1
+        fields[field] = field_kind(field_type, _inherited(objects, num, 'ff'))
+    fields_by_type = {}
+    for kind in fields.values():
+        fields_by_type[kind] = fields_by_type.get(kind, 0) + 1
+        
+    # Поля верхнего уровня должны быть перечислены в /AcroForm /Fields
+    top_level = set()
+    for field in fields:
+        seen = set()
+        while objects.get(field, {}).get('parent') in objects and field not in seen:
+            seen.add(field)
+            field = objects[field]['parent']
+        top_level.add(field)
+        
+    xfa = bool(acroform.get('xfa') or catalog.get('xfa'))
+    
+    symptoms = []
+    if widgets and not has_acroform:
+        symptoms.append('widgets_without_acroform')
+    if has_acroform and widgets and listed_fields is not None and not listed_fields:
+        symptoms.append('empty_fields_array')
+    unlisted = len(top_level - set(listed_fields or ())) if has_acroform and listed_fields else 0
+    if unlisted:
+        symptoms.append('fields_not_in_acroform')
+    if untyped:
+        symptoms.append('widgets_without_field_type')
+    if len(widgets - placed) and pages:
+        symptoms.append('widgets_not_on_pages')
+    if xfa and not widgets:
+        symptoms.append('xfa_without_widgets')
+        
+    return {
+        'size': len(data),
+        'analyzed': True,
+        'objects': len(objects),
+        'object_streams': object_streams,
+        'pages': len(pages),
+        'acroform': has_acroform,
+        'xfa': xfa,
+        'need_appearances': acroform.get('need_appearances'),
+        'widgets': len(widgets),
+        'fields': {'total': len(fields), 'by_type': fields_by_type},
+        'fields_by_page': pages_report,
+        'unlisted_fields': unlisted,
+        'symptoms': symptoms,
+        'notes': notes,
+    }
+
+
+def analyze_pdf_file(pdf_path):
+    """
+    analyze_pdf_bytes над файлом, отображенным в память (mmap)
+    """
+    with open(pdf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {'error': 'пустой файл'}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return analyze_pdf_bytes(data)
+
+
+def analyze_pdf_directory(directory, report_path=ANALYSIS_REPORT_PATH):
+    """
+    Анализирует все PDF каталога и сохраняет единый JSON-отчет: по файлу на
+    запись (см. analyze_pdf_bytes) и сводку - сколько файлов с AcroForm, с XFA,
+    с признаками повреждения и сколько полей каждого вида.
+
+    Returns:
+        dict: отчет (то же, что записано в report_path; None - не записывать).
+    """
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not (name.lower().endswith('.pdf') and os.path.isfile(path)):
+            continue
+        try:
+            files[name] = analyze_pdf_file(path)
+        except Exception as e:
+            files[name] = {'error': str(e)}
+            
+    fields_by_type = {}
+    for report in files.values():
+        for kind, count in (report.get('fields') or {}).get('by_type', {}).items():
+            fields_by_type[kind] = fields_by_type.get(kind, 0) + count
+    summary = {
+        'files': len(files),
+        'acroform': sum(1 for report in files.values() if report.get('acroform')),
+        'xfa': sum(1 for report in files.values() if report.get('xfa')),
+        'broken': sorted(name for name, report in files.items() if report.get('symptoms')),
+        'errors': sorted(name for name, report in files.items() if 'error' in report),
+        'not_analyzed': sorted(name for name, report in files.items() if report.get('analyzed') is False),
+        'fields_by_type': fields_by_type,
+    }
+    report = {'directory': os.path.abspath(directory), 'summary': summary, 'files': files}
+    
+    if report_path:
+        save_json_atomic(report_path, report)
+    return report
+
 
 def analyze_pdf_structure(pdf_path):
     """Детальный анализ структуры PDF"""
@@ -0,0 +1,350 @@
+"""
+Синтетический бенчмарк заполнения PDF-форм.
+
+Генерирует AcroForm-шаблоны с заданным числом полей (текстовые поля,
+чек-боксы, группы радиокнопок), колонку маппинга и анкеты заявителей,
+после чего прогоняет через fill_pdf_form только этап заполнения - без
+Google Sheets/Drive. Результаты сохраняются в JSON, чтобы сравнивать
+прогоны между собой.
+
+Пример:
+    python benchmark.py --fields 10 100 500 2000 --applicants 200
+    python benchmark.py --fields 400 --compare bench_results/bench_20260101_120000.json
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+from pypdf import PdfWriter, __version__ as pypdf_version
+from pypdf.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject,
+                           NameObject, NumberObject, TextStringObject)
+
+import main
+
+# Каталог для JSON-результатов
+RESULTS_DIR = 'bench_results'
+# Размещение полей на странице
+FIELDS_PER_PAGE = 40
+# Доли типов полей в синтетическом шаблоне
+CHECKBOX_SHARE = 0.2
+RADIO_SHARE = 0.1
+RADIO_OPTIONS = ('Opt1', 'Opt2', 'Opt3')
+
+# Флаги поля /Ff для радиокнопок: Radio (бит 16) + NoToggleToOff (бит 15)
+RADIO_FLAGS = (1 << 15) | (1 << 14)
+
+
+def _appearance(writer, width, height, content=b''):
+    stream = DecodedStreamObject()
+    stream.set_data(content)
+    stream.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Form'),
+        NameObject('/BBox'): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(width), FloatObject(height)]),
+    })
+    return writer._add_object(stream)
+
+
+def _widget(writer, page, rect):
+    return DictionaryObject({
+        NameObject('/Type'): NameObject('/Annot'),
+        NameObject('/Subtype'): NameObject('/Widget'),
+        NameObject('/Rect'): ArrayObject([FloatObject(v) for v in rect]),
+        NameObject('/P'): page.indirect_reference,
+        NameObject('/F'): NumberObject(4),
+    })
+
+
+def _button_states(writer, on_state, size):
+    on = _appearance(writer, size, size, b'0 g 2 2 8 8 re f')
+    off = _appearance(writer, size, size)
+    return DictionaryObject({
+        NameObject('/N'): DictionaryObject({NameObject('/' + on_state): on, NameObject('/Off'): off}),
+    })
+
+
+def generate_template(field_count, seed=0):
+    """
+    Создает синтетический шаблон с field_count полями.
+
+    Returns:
+        tuple: (байты PDF, список полей [(имя, тип, варианты)]), где тип -
+               'text', 'checkbox' или 'radio'.
+    """
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    fields = ArrayObject()
+    field_specs = []
+    pages = []
+
+    for index in range(field_count):
+        if index % FIELDS_PER_PAGE == 0:
+            page = writer.add_blank_page(612, 792)
+            page[NameObject('/Annots')] = ArrayObject()
+            pages.append(page)
+        page = pages[-1]
+        slot = index % FIELDS_PER_PAGE
+        x = 40 + (slot % 2) * 280
+        y = 760 - (slot // 2) * 36
+
+        roll = rng.random()
+        name = f"field_{index:04d}"
+        if roll < RADIO_SHARE:
+            parent = DictionaryObject({
+                NameObject('/FT'): NameObject('/Btn'),
+                NameObject('/Ff'): NumberObject(RADIO_FLAGS),
+                NameObject('/T'): TextStringObject(name),
+                NameObject('/V'): NameObject('/Off'),
+            })
+            parent_ref = writer._add_object(parent)
+            kids = ArrayObject()
+            for option_index, option in enumerate(RADIO_OPTIONS):
+                kid = _widget(writer, page, (x + option_index * 20, y, x + option_index * 20 + 12, y + 12))
+                kid[NameObject('/Parent')] = parent_ref
+                kid[NameObject('/AS')] = NameObject('/Off')
+                kid[NameObject('/AP')] = _button_states(writer, option, 12)
+                kid_ref = writer._add_object(kid)
+                kids.append(kid_ref)
+                page['/Annots'].append(kid_ref)
+            parent[NameObject('/Kids')] = kids
+            fields.append(parent_ref)
+            field_specs.append((name, 'radio', RADIO_OPTIONS))
+        elif roll < RADIO_SHARE + CHECKBOX_SHARE:
+            widget = _widget(writer, page, (x, y, x + 12, y + 12))
+            widget.update({
+                NameObject('/FT'): NameObject('/Btn'),
+                NameObject('/T'): TextStringObject(name),
+                NameObject('/V'): NameObject('/Off'),
+                NameObject('/AS'): NameObject('/Off'),
+                NameObject('/AP'): _button_states(writer, 'Yes', 12),
+            })
+            widget_ref = writer._add_object(widget)
+            page['/Annots'].append(widget_ref)
+            fields.append(widget_ref)
+            field_specs.append((name, 'checkbox', ('Yes',)))
+        else:
+            widget = _widget(writer, page, (x, y, x + 240, y + 20))
+            widget.update({
+                NameObject('/FT'): NameObject('/Tx'),
+                NameObject('/T'): TextStringObject(name),
+                NameObject('/DA'): TextStringObject('/Helv 10 Tf 0 g'),
+                NameObject('/MaxLen'): NumberObject(40),
+            })
+            widget_ref = writer._add_object(widget)
+            page['/Annots'].append(widget_ref)
+            fields.append(widget_ref)
+            field_specs.append((name, 'text', ()))
+
+    helv = writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    }))
+    writer._root_object[NameObject('/AcroForm')] = DictionaryObject({
+        NameObject('/Fields'): fields,
+        NameObject('/DA'): TextStringObject('/Helv 10 Tf 0 g'),
+        NameObject('/DR'): DictionaryObject({
+            NameObject('/Font'): DictionaryObject({NameObject('/Helv'): helv}),
+        }),
+    })
+
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue(), field_specs
+
+
+def generate_mapping(field_specs):
+    """
+    Колонка маппинга шаблона: поле анкеты 'Поле N' -> поле PDF
+    """
+    return {f"Поле {index}": name for index, (name, _, _) in enumerate(field_specs)}
+
+
+def generate_applicants(field_specs, count, seed=0):
+    """
+    Анкеты заявителей со значениями всех полей маппинга
+    """
+    rng = random.Random(seed)
+    letters = 'абвгдежзиклмнопрстуфхцчшщэюяABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    applicants = []
+    for _ in range(count):
+        data = {}
+        for index, (_, field_type, options) in enumerate(field_specs):
+            if field_type == 'text':
+                data[f"Поле {index}"] = ''.join(rng.choice(letters) for _ in range(rng.randint(3, 30)))
+            elif field_type == 'checkbox':
+                data[f"Поле {index}"] = rng.choice(('Yes', 'Off'))
+            else:
+                data[f"Поле {index}"] = rng.choice(options)
+        applicants.append(data)
+    return applicants
+
+
+def peak_rss_mb():
+    """
+    Пиковый объем резидентной памяти процесса в МБ (None, если определить нельзя).
+    Это максимум за всю жизнь процесса, поэтому каждый случай бенчмарка
+    выполняется в своем процессе (см. run_case_isolated).
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # В Linux ru_maxrss в КБ, в macOS - в байтах
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_case(field_count, applicant_count, work_dir, seed=0):
+    """
+    Прогоняет заполнение одного синтетического шаблона для всех анкет
+    """
+    template_bytes, field_specs = generate_template(field_count, seed)
+    template_name = f"bench_{field_count}.pdf"
+    template_path = os.path.join(work_dir, template_name)
+    with open(template_path, 'wb') as f:
+        f.write(template_bytes)
+
+    mapping = {template_name: generate_mapping(field_specs)}
+    applicants = generate_applicants(field_specs, applicant_count, seed)
+
+    template_cache = main.TemplateCache()
+    buffer = BytesIO()
+
+    # Разбор шаблона и компиляция плана - один раз за запуск, в замер не входят
+    fill_plan = main.get_fill_plan({}, template_cache, mapping, template_name, template_path, template_name)
+
+    latencies = []
+    output_bytes = 0
+    failures = 0
+    started = time.perf_counter()
+    # Отладочный вывод fill_pdf_form в замер не попадает
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for data in applicants:
+            buffer.seek(0)
+            buffer.truncate()
+            t0 = time.perf_counter()
+            ok = main.fill_pdf_form(template_path, buffer, data, mapping, template_name, fill_plan, template_cache)
+            latencies.append(time.perf_counter() - t0)
+            if ok:
+                output_bytes += buffer.tell()
+            else:
+                failures += 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'fields': field_count,
+        'field_types': {kind: sum(1 for _, t, _ in field_specs if t == kind) for kind in ('text', 'checkbox', 'radio')},
+        'pages': (field_count + FIELDS_PER_PAGE - 1) // FIELDS_PER_PAGE,
+        'template_bytes': len(template_bytes),
+        'documents': applicant_count,
+        'failures': failures,
+        'seconds': elapsed,
+        'docs_per_sec': applicant_count / elapsed if elapsed else None,
+        'latency_ms': {
+            'mean': statistics.fmean(latencies) * 1000 if latencies else None,
+            'p50': percentile(latencies, 0.50) * 1000 if latencies else None,
+            'p90': percentile(latencies, 0.90) * 1000 if latencies else None,
+            'p99': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'max': latencies[-1] * 1000 if latencies else None,
+        },
+        'avg_output_bytes': output_bytes // max(1, applicant_count - failures),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _run_case_quiet(field_count, applicant_count, work_dir, seed):
+    main.DEBUG_INFO = False
+    return run_case(field_count, applicant_count, work_dir, seed)
+
+
+def run_case_isolated(field_count, applicant_count, work_dir, seed=0):
+    """
+    run_case в отдельном новом процессе (spawn): пиковая RSS относится только
+    к этому случаю, а не к самому тяжелому из прогнанных до него
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_case_quiet, field_count, applicant_count, work_dir, seed).result()
+
+
+def print_results(results, baseline=None):
+    baseline_cases = {case['fields']: case for case in (baseline or {}).get('cases', [])}
+    print(f"{'полей':>6} {'док/с':>9} {'p50 мс':>8} {'p90 мс':>8} {'p99 мс':>8} {'RSS МБ':>8}  сравнение")
+    for case in results['cases']:
+        latency = case['latency_ms']
+        rss = case['peak_rss_mb']
+        line = (f"{case['fields']:>6} {case['docs_per_sec']:>9.1f} {latency['p50']:>8.2f} "
+                f"{latency['p90']:>8.2f} {latency['p99']:>8.2f} {rss if rss is None else round(rss, 1)!s:>8}")
+        base = baseline_cases.get(case['fields'])
+        if base and base.get('docs_per_sec'):
+            line += f"  x{case['docs_per_sec'] / base['docs_per_sec']:.2f} к базовому"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Синтетический бенчмарк заполнения PDF-форм')
+    parser.add_argument('--fields', type=int, nargs='+', default=[10, 100, 500, 2000],
+                        help='число полей в синтетических шаблонах')
+    parser.add_argument('--applicants', type=int, default=100, help='число анкет на шаблон')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора данных')
+    parser.add_argument('--output', help='файл для JSON-результатов (по умолчанию bench_results/bench_<время>.json)')
+    parser.add_argument('--compare', metavar='JSON', help='результаты прошлого прогона для сравнения')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main.DEBUG_INFO = False
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    work_dir = os.path.join(RESULTS_DIR, 'templates')
+    os.makedirs(work_dir, exist_ok=True)
+
+    started_at = datetime.now()
+    results = {
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pypdf': pypdf_version,
+        'platform': platform.platform(),
+        'applicants': args.applicants,
+        'seed': args.seed,
+        'cases': [],
+    }
+    for field_count in args.fields:
+        print(f"Шаблон на {field_count} полей, анкет: {args.applicants}...")
+        results['cases'].append(run_case_isolated(field_count, args.applicants, work_dir, args.seed))
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f"bench_{started_at:%Y%m%d_%H%M%S}.json")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=1)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"Результаты сохранены: {output_path}")
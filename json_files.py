@@ -0,0 +1,41 @@
+import json
+import os
+
+
+def write_atomic(path, text):
+    """
+    Записывает text в path через временный файл и rename: прерванная запись
+    не оставляет файл поврежденным, а читатель (например, textfile collector
+    Prometheus) не увидит его наполовину записанным
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def load_json(path):
+    """
+    Содержимое JSON-файла; None, если файла нет или его не удалось прочитать
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Ошибка при чтении {path}: {e}")
+        return None
+
+
+def save_json_atomic(path, value, sort_keys=False):
+    """
+    Сохраняет value в JSON-файл атомарно (см. write_atomic).
+    Возвращает False, если сохранить не удалось.
+    """
+    try:
+        write_atomic(path, json.dumps(value, ensure_ascii=False, indent=1, sort_keys=sort_keys))
+        return True
+    except Exception as e:
+        print(f"Ошибка при сохранении {path}: {e}")
+        return False
@@ -0,0 +1,292 @@
+import csv
+import hashlib
+import os
+import shutil
+from datetime import date, datetime, time, timezone
+
+# openpyxl нужен только для чтения .xlsx; для CSV не требуется
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Раскладка каталога локального бэкенда:
+#   <root>/Clients_for_PDF/<Фамилия>.csv   - вкладки анкет (значение в A, название поля в B)
+#     или <root>/Clients_for_PDF.xlsx      - по листу на заявителя
+#   <root>/Mapping.csv                     - лист Map
+#     или <root>/Mapping.xlsx (лист Map)
+#   <root>/PDF_templates/*.pdf             - шаблоны
+#   <root>/FilledPDF/<Фамилия>/*.pdf       - результаты
+CLIENTS_NAME = 'Clients_for_PDF'
+MAPPING_NAME = 'Mapping'
+MAPPING_SHEET = 'Map'
+TEMPLATES_FOLDER = 'PDF_templates'
+FILLED_FOLDER = 'FilledPDF'
+# Анкет в группе chunk_applicants (у Sheets группа ограничена длиной запроса batchGet)
+APPLICANT_CHUNK_SIZE = 50
+
+
+def _trim_row(row):
+    """
+    Убирает пустые ячейки в конце строки - так же возвращает строки Sheets API
+    """
+    row = ['' if cell is None else cell for cell in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def _read_csv(path):
+    # utf-8-sig: CSV, сохраненные из Excel, начинаются с BOM
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return [_trim_row(row) for row in csv.reader(f)]
+
+
+def _open_workbook(path):
+    if openpyxl is None:
+        raise RuntimeError(f"Для чтения {path} нужен пакет openpyxl (pip install openpyxl)")
+    return openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+
+def _format_date(value):
+    # Даты и время - в формате ячеек таблиц (русская локаль Sheets)
+    if isinstance(value, datetime):
+        return value.strftime('%d.%m.%Y %H:%M:%S' if value.time() != time() else '%d.%m.%Y')
+    if isinstance(value, date):
+        return value.strftime('%d.%m.%Y')
+    return value.strftime('%H:%M:%S')
+
+
+def _format_cell(value):
+    """
+    Значение ячейки openpyxl в виде строки, как Sheets API возвращает
+    отформатированные значения (FORMATTED_VALUE)
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (datetime, date, time)):
+        return _format_date(value)
+    return str(value)
+
+
+def _unformatted_cell(value):
+    """
+    Значение ячейки openpyxl так, как Sheets API возвращает его при
+    UNFORMATTED_VALUE и dateTimeRenderOption=FORMATTED_STRING: числа и
+    логические значения как есть, даты - строкой (см. GoogleBackend)
+    """
+    if isinstance(value, (datetime, date, time)):
+        return _format_date(value)
+    return value
+
+
+def _read_xlsx_sheets(path, sheet_names, convert_cell):
+    """
+    Строки листов sheet_names одной книги (книга открывается один раз):
+    имя листа -> строки, значения ячеек через convert_cell
+    """
+    workbook = _open_workbook(path)
+    try:
+        return {sheet_name: [_trim_row([convert_cell(cell) for cell in row])
+                             for row in workbook[sheet_name].iter_rows(values_only=True)]
+                for sheet_name in sheet_names}
+    finally:
+        workbook.close()
+
+
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _format_time(timestamp):
+    # Формат modifiedTime Drive API (RFC 3339, UTC)
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class LocalBackend:
+    """
+    Замена Google Sheets и Google Drive на локальный каталог: анкеты и маппинг
+    читаются из CSV/XLSX, папки Drive - обычные каталоги, ID файла или папки -
+    путь относительно корня. Нужен для прогонов без доступа к Google
+    (профилирование, регрессионные проверки на CI).
+    """
+    def __init__(self, root, folder_aliases=None, file_aliases=None):
+        """
+        Args:
+            root (str): корневой каталог с данными.
+            folder_aliases (dict, optional): ID папок Drive -> подкаталог root,
+                                             чтобы основной код мог передавать свои ID.
+            file_aliases (dict, optional): ID таблиц -> имя файла или каталога без
+                                           расширения (CLIENTS_NAME, MAPPING_NAME);
+                                           под этими ID они попадают в ленту изменений.
+        """
+        self.root = os.path.abspath(root)
+        self.folder_aliases = folder_aliases or {}
+        self.file_aliases = file_aliases or {}
+        # Источник данных для снимка маппинга и состояния --watch
+        self.source = self.root
+
+    def _path(self, item_id):
+        return os.path.join(self.root, self.folder_aliases.get(item_id, item_id))
+
+    def _clients_xlsx(self):
+        path = os.path.join(self.root, CLIENTS_NAME + '.xlsx')
+        return path if os.path.exists(path) else None
+
+    # --- Sheets ---
+
+    def get_applicant_tabs(self):
+        """
+        Названия вкладок анкет (фамилии заявителей)
+        """
+        xlsx_path = self._clients_xlsx()
+        if xlsx_path:
+            workbook = _open_workbook(xlsx_path)
+            try:
+                return list(workbook.sheetnames)
+            finally:
+                workbook.close()
+
+        clients_dir = os.path.join(self.root, CLIENTS_NAME)
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(clients_dir) if name.lower().endswith('.csv'))
+
+    def get_applicant_values(self, surname):
+        """
+        Строки вкладки заявителя в формате values Sheets API
+        """
+        return self.get_applicants_values([surname])[surname]
+
+    def chunk_applicants(self, surnames):
+        """
+        Группы заявителей по APPLICANT_CHUNK_SIZE
+        """
+        return [surnames[start:start + APPLICANT_CHUNK_SIZE] for start in range(0, len(surnames), APPLICANT_CHUNK_SIZE)]
+
+    def get_applicants_values(self, surnames):
+        """
+        Строки вкладок группы заявителей: фамилия -> строки. Книга XLSX
+        открывается один раз на группу.
+        """
+        xlsx_path = self._clients_xlsx()
+        if xlsx_path:
+            return _read_xlsx_sheets(xlsx_path, surnames, _unformatted_cell)
+        return {surname: _read_csv(os.path.join(self.root, CLIENTS_NAME, surname + '.csv')) for surname in surnames}
+
+    def _mapping_path(self):
+        xlsx_path = os.path.join(self.root, MAPPING_NAME + '.xlsx')
+        return xlsx_path if os.path.exists(xlsx_path) else os.path.join(self.root, MAPPING_NAME + '.csv')
+
+    def get_mapping_version(self):
+        """
+        Версия файла маппинга в формате files().get(fields='modifiedTime, version')
+        """
+        path = self._mapping_path()
+        stat = os.stat(path)
+        return {'modifiedTime': _format_time(stat.st_mtime), 'version': str(stat.st_mtime_ns)}
+
+    def get_mapping_values(self):
+        """
+        Строки листа Map в формате values Sheets API (значения - строки)
+        """
+        path = self._mapping_path()
+        if path.endswith('.xlsx'):
+            return _read_xlsx_sheets(path, [MAPPING_SHEET], _format_cell)[MAPPING_SHEET]
+        return _read_csv(path)
+
+    # --- Drive ---
+
+    def iter_files(self, folder_id):
+        """
+        PDF-файлы папки в формате files().list (id, name, md5Checksum, modifiedTime)
+        """
+        folder_path = self._path(folder_id)
+        for name in sorted(os.listdir(folder_path)):
+            path = os.path.join(folder_path, name)
+            if not (os.path.isfile(path) and name.lower().endswith('.pdf')):
+                continue
+            yield {
+                'id': os.path.relpath(path, self.root),
+                'name': name,
+                'md5Checksum': _file_md5(path),
+                'modifiedTime': _format_time(os.path.getmtime(path)),
+            }
+
+    def find_folder(self, folder_name, parent_folder_id):
+        path = os.path.join(self._path(parent_folder_id), folder_name)
+        return os.path.relpath(path, self.root) if os.path.isdir(path) else None
+
+    def create_folder(self, folder_name, parent_folder_id):
+        """
+        Возвращает ID папки folder_name, создавая ее при необходимости
+        """
+        path = os.path.join(self._path(parent_folder_id), folder_name)
+        os.makedirs(path, exist_ok=True)
+        return os.path.relpath(path, self.root)
+
+    def resolve_folders(self, folder_names, parent_folder_id):
+        """
+        ID папок folder_names в parent_folder_id (создаются при необходимости)
+        """
+        return {folder_name: self.create_folder(folder_name, parent_folder_id) for folder_name in folder_names}
+
+    def _walk_files(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                yield os.path.join(directory, name)
+
+    def get_start_page_token(self):
+        """
+        Позиция ленты изменений: наибольшее время изменения файла (нс)
+        """
+        return str(max((os.stat(path).st_mtime_ns for path in self._walk_files()), default=0))
+
+    def list_changes(self, page_token):
+        """
+        Файлы, измененные после page_token, в формате changes.list; удаление
+        файлов не отслеживается. Returns: (изменения, новая позиция).
+        """
+        since = int(page_token)
+        latest = since
+        changes = []
+        folder_ids = {folder: folder_id for folder_id, folder in self.folder_aliases.items()}
+        file_ids = {name: file_id for file_id, name in self.file_aliases.items()}
+        for path in self._walk_files():
+            modified = os.stat(path).st_mtime_ns
+            if modified <= since:
+                continue
+            latest = max(latest, modified)
+            relative = os.path.relpath(path, self.root)
+            parent = os.path.dirname(relative)
+            top_name = os.path.splitext(relative.split(os.sep)[0])[0]
+            changes.append({
+                'fileId': file_ids.get(top_name, relative),
+                'file': {'name': os.path.basename(path), 'parents': [folder_ids.get(parent, parent)]},
+            })
+        return changes, str(latest)
+
+    def download(self, file_id, destination):
+        shutil.copyfile(self._path(file_id), destination)
+
+    def upload(self, folder_id, file_name, data=None, file_path=None, file_id=None):
+        """
+        Сохраняет PDF в папку. При указанном file_id перезаписывается этот файл.
+        Возвращает ID файла.
+        """
+        if file_id and os.path.exists(self._path(file_id)):
+            path = self._path(file_id)
+        else:
+            path = os.path.join(self._path(folder_id), file_name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        else:
+            shutil.copyfile(file_path, path)
+        return os.path.relpath(path, self.root)
@@ -1,21 +1,167 @@
+import argparse
+import hashlib
+import json
+import logging
 import os
+import random
+import re
 import sys
-#  import PyPDF
-from pypdf import PdfReader, PdfWriter
-from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from io import BytesIO
+from urllib.parse import quote
+from google.auth.credentials import Credentials
+from googleapiclient.errors import HttpError
 
-from PDFRepair import *
+# pypdf, клиенты Google API и PDFRepair импортируются в местах использования:
+# запуск с --help, --local или --analyze не платит за их загрузку
+from json_files import load_json, save_json_atomic
+from pipeline import Stage, run_pipeline
+from local_backend import LocalBackend, CLIENTS_NAME, MAPPING_NAME, TEMPLATES_FOLDER, FILLED_FOLDER
+from run_metrics import RunMetrics, adopt_stage, count_api_calls, current_stage
 
 # Настройка Google Sheets и Google Drive
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'C:/Users/Admin/OneDrive/Документы/pdfassistantforapplicants-5c2af679fac9.json'  # Путь к вашему JSON файлу сервисного аккаунта
 
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-sheets_service = build('sheets', 'v4', credentials=credentials)
-drive_service = build('drive', 'v3', credentials=credentials)
+class SharedCredentials(Credentials):
+    """
+    Ключ сервисного аккаунта, общий для всех потоков. Токен обновляется под
+    блокировкой: когда он истекает, его обновляет один поток, остальные
+    получают уже обновленный, а не запрашивают каждый свой. Наследуется от
+    google.auth Credentials: только такие объекты googleapiclient признает
+    учетными данными google-auth (в том числе в пакетных запросах).
+    """
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._lock = threading.Lock()
+        super().__init__()
+        
+    # token и expiry хранятся в исходных учетных данных; базовый __init__ присваивает им None
+    @property
+    def token(self):
+        return self._credentials.token
+        
+    @token.setter
+    def token(self, value):
+        self._credentials.token = value
+        
+    @property
+    def expiry(self):
+        return self._credentials.expiry
+        
+    @expiry.setter
+    def expiry(self, value):
+        self._credentials.expiry = value
+        
+    @property
+    def quota_project_id(self):
+        return self._credentials.quota_project_id
+        
+    @property
+    def universe_domain(self):
+        return self._credentials.universe_domain
+        
+    def refresh(self, request):
+        with self._lock:
+            self._credentials.refresh(request)
+            
+    def apply(self, headers, token=None):
+        self._credentials.apply(headers, token=token)
+        
+    def before_request(self, request, method, url, headers):
+        if not self._credentials.valid:
+            with self._lock:
+                if not self._credentials.valid:
+                    self._credentials.refresh(request)
+        self._credentials.apply(headers)
+
+class ClientPool:
+    """
+    Авторизованные клиенты Google API для всех потоков. Объекты сервисов
+    создаются один раз и только строят запросы; выполняет их execute_request
+    на HTTP-транспорте, взятом из пула на время запроса (checkout).
+    httplib2.Http нельзя использовать из нескольких потоков одновременно, но
+    транспорт переживает поток, который его брал: короткоживущие потоки пулов
+    и этапов и новые проходы --watch получают уже открытые соединения
+    keep-alive, без нового TLS-рукопожатия. Транспортов создается столько,
+    сколько запросов выполнялось одновременно. Токен сервисного аккаунта
+    общий (SharedCredentials). Документ discovery берется из копии,
+    поставляемой с google-api-python-client (static_discovery), без запроса в сеть.
+    """
+    def __init__(self):
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._idle = []
+        self._services = {}
+        
+    def credentials(self):
+        """
+        Ключ сервисного аккаунта; загружается при первом обращении к API
+        """
+        with self._lock:
+            if self._credentials is None:
+                from google.oauth2 import service_account
+                self._credentials = SharedCredentials(service_account.Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_FILE, scopes=SCOPES))
+            return self._credentials
+            
+    def _new_http(self):
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        return AuthorizedHttp(self.credentials(), http=httplib2.Http())
+        
+    @contextmanager
+    def checkout(self):
+        """
+        Авторизованный HTTP-транспорт в монопольное пользование на время блока;
+        после блока он возвращается в пул
+        """
+        with self._lock:
+            http = self._idle.pop() if self._idle else None
+        if http is None:
+            http = self._new_http()
+        try:
+            yield http
+        finally:
+            with self._lock:
+                self._idle.append(http)
+                
+    def service(self, name, version):
+        """
+        Клиент API name/version (общий для всех потоков)
+        """
+        service = self._services.get((name, version))
+        if service is None:
+            from googleapiclient.discovery import build
+            # Транспорт сервиса запросы не выполняет: execute_request передает свой из пула
+            service = build(name, version, http=self._new_http(), static_discovery=True, cache_discovery=False)
+            with self._lock:
+                service = self._services.setdefault((name, version), service)
+        return service
+
+client_pool = ClientPool()
+
+class LazyService:
+    """
+    Клиент Google API, который создается при первом обращении: атрибуты
+    берутся у общего объекта сервиса из client_pool.
+    """
+    def __init__(self, name, version):
+        self._name = name
+        self._version = version
+        
+    def __getattr__(self, attr):
+        return getattr(client_pool.service(self._name, self._version), attr)
+
+# Клиенты Sheets и Drive создаются при первом запросе (см. GoogleBackend)
+sheets_service = LazyService('sheets', 'v4')
+drive_service = LazyService('drive', 'v3')
 
 # ID Google Sheets документов и папок на Google Drive
 CLIENTS_SPREADSHEET_ID = '1GcE51R3_L07o5w0deD7Axk32EWJVMnOhwZmNXmWCjIg'
@@ -23,273 +169,1772 @@ MAPPING_SPREADSHEET_ID = '19MfKvlPe6P7slOlYVi0frrpgx53jHh_cCShfH49WlaA'
 PDF_TEMPLATES_FOLDER_ID = '1gtDHd8tDwYpNqikGoKixufJtLvuTfKyZ'
 FILLED_PDF_FOLDER_ID = '1hV2nO47XHAB1RKfwsVctkOj_2OEOuAb3'
 
+# Ограничение длины строки запроса batchGet (диапазоны передаются в URL)
+BATCH_GET_MAX_URL_CHARS = 8000
+
+# Размер страницы листинга Drive (максимум API - 1000)
+DRIVE_PAGE_SIZE = 1000
+
+# Локальный кэш шаблонов: индекс в папке templates и число потоков скачивания
+TEMPLATE_INDEX_FILE = 'index.json'
+TEMPLATE_DOWNLOAD_WORKERS = 8
+
+# Максимум запросов в одном пакетном HTTP-запросе Drive API
+DRIVE_BATCH_LIMIT = 100
+
+# Ограничение памяти под кэш разобранных шаблонов (байт)
+TEMPLATE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Загрузка на Drive: файлы больше порога идут возобновляемой сессией частями
+# (размер части должен быть кратен 256 КБ)
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# Сколько раз подряд продолжать прерванную загрузку
+UPLOAD_RESUME_ATTEMPTS = 5
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# Квоты API (запросов в минуту) и повторы при ошибках лимитов/сервера
+SHEETS_REQUESTS_PER_MINUTE = 60
+DRIVE_REQUESTS_PER_MINUTE = 12000
+API_MAX_RETRIES = 6
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 64.0
+
+# Манифест загруженных результатов (рядом с filled_forms/)
+MANIFEST_PATH = 'filled_manifest.json'
+
+# Лист маппинга и локальный снимок его разбора (сверяется с версией файла на Drive)
+MAPPING_SHEET_NAME = 'Map'
+MAPPING_SNAPSHOT_PATH = 'mapping_snapshot.json'
+
+# Локальные копии загруженных результатов - основа инкрементальных обновлений (--incremental)
+PREVIOUS_OUTPUTS_DIR = 'previous_outputs'
+
+# Потоковый конвейер прохода по заявителям (см. process_applicants):
+# емкость очередей между этапами, потоков поиска/создания папок и загрузки
+# на Drive по умолчанию (--queue-size, --folder-workers, --upload-workers)
+PIPELINE_QUEUE_SIZE = 64
+FOLDER_WORKERS = 2
+UPLOAD_WORKERS = 4
+
+# Режим --watch: сохраненная позиция в ленте изменений Drive и период опроса
+WATCH_STATE_PATH = 'watch_state.json'
+WATCH_POLL_SECONDS = 10
+
+# Итоговые метрики запуска: JSON-сводка и textfile для Prometheus
+METRICS_JSON_PATH = 'run_metrics.json'
+METRICS_PROM_PATH = 'run_metrics.prom'
+
+# Предупреждение pypdf о символах, которых нет в кодировке шрифта поля, выводится
+# на каждое кириллическое значение; такие поля перерисовывает просмотрщик (см. write_field_values)
+logging.getLogger('pypdf.generic._appearance_stream').setLevel(logging.ERROR)
+
+# Строки-маркеры в колонке A маппинга: часть даты из поля анкеты строкой выше
+DATE_PART_MARKERS = {'#DAY': 'day', '#MONTH': 'month', '#YEAR': 'year'}
+
+# Модификаторы в ячейке маппинга: "поле PDF|upper|date:%d.%m.%Y"
+MAPPING_MODIFIER_SEPARATOR = '|'
+
+# Серийный номер даты Sheets - число дней от этой даты. Ячейки-даты приходят
+# строкой (FORMATTED_STRING), числом - только даты в ячейках с числовым форматом
+SHEETS_EPOCH = datetime(1899, 12, 30)
+# Форматы дат, которые распознаются в значениях анкеты: ISO, формат ячеек
+# таблицы анкет (русская локаль - ДД.ММ.ГГГГ, с временем - ДД.ММ.ГГГГ Ч:ММ:СС)
+DATE_INPUT_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d/%m/%Y',
+                      '%Y-%m-%d %H:%M:%S')
+
+# Значения анкеты, которые отмечают флажок (сравниваются без учета регистра)
+CHECKBOX_TRUE_VALUES = frozenset({'1', 'true', 'yes', 'y', 'on', 'x', 'х', '+', '✓', 'да', 'д'})
+
+# Флаг /Ff переключателя (radio) у поля /Btn
+RADIO_FIELD_FLAG = 1 << 15
+
 # выводить отладку
 DEBUG_INFO = True
 # проверять корректность данных
 VALIDATION_ON = False
 
+class TokenBucket:
+    """
+    Ведро токенов для равномерного расхода квоты API: rate_per_minute
+    запросов в минуту, допускается всплеск до capacity запросов.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, rate_per_minute // 6)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+        
+    def acquire(self, tokens=1):
+        """
+        Забирает tokens токенов, при необходимости ожидая их накопления.
+        Возвращает время ожидания в секундах.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # Запрос дороже емкости ведра (пакет) ждет до полного ведра
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return waited
+                delay = (needed - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+# Квоты API: отдельное ведро токенов на Sheets и на Drive
+API_BUCKETS = {
+    'sheets': TokenBucket(SHEETS_REQUESTS_PER_MINUTE),
+    'drive': TokenBucket(DRIVE_REQUESTS_PER_MINUTE),
+}
+
+# Счетчики вызовов API: calls - запросы, throttled - задержаны квотой или
+# отклонены сервером по лимиту, retried - повторы, failed - окончательные ошибки
+api_stats = {api: {'calls': 0, 'throttled': 0, 'retried': 0, 'failed': 0} for api in API_BUCKETS}
+_api_stats_lock = threading.Lock()
+
+def count_api_event(api, event, amount=1):
+    with _api_stats_lock:
+        api_stats[api][event] += amount
+
+def acquire_quota(api, cost=1):
+    """
+    Ожидает свободную квоту для cost запросов к api ('sheets' или 'drive')
+    """
+    if API_BUCKETS[api].acquire(cost) > 0:
+        count_api_event(api, 'throttled')
+    count_api_event(api, 'calls', cost)
+    # Запросы относятся к этапу, который выполняется в этом потоке
+    count_api_calls(cost)
+
+def is_rate_limit_error(error):
+    """
+    True для ответов 429 и 403 с причиной rateLimitExceeded/userRateLimitExceeded
+    """
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403:
+        return False
+    try:
+        details = json.loads(error.content.decode('utf-8'))['error']['errors']
+        return any(item.get('reason') in ('rateLimitExceeded', 'userRateLimitExceeded') for item in details)
+    except Exception:
+        return False
+
+def is_retryable_error(error):
+    """
+    True, если после ошибки запрос имеет смысл повторить
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS_CODES or is_rate_limit_error(error)
+    import httplib2
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+def backoff_delay(attempt):
+    """
+    Экспоненциальная задержка с полным джиттером для попытки attempt (с 0)
+    """
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt)))
+
+def execute_request(request, api, cost=1, idempotent=True, recover=None):
+    """
+    Единая точка выполнения запросов к Sheets и Drive: ожидает квоту
+    в ведре токенов api, выполняет запрос и повторяет его с экспоненциальной
+    задержкой при ошибках лимитов, 5xx и сетевых сбоях.
+
+    Запрос, повтор которого может создать дубликат (files().create), после
+    сетевого сбоя или 5xx мог и выполниться - ответ просто потерян. Такой
+    запрос (idempotent=False) повторяется только после отказа по лимиту
+    (429, 403 rateLimitExceeded): его сервер точно не выполнял. Если передан
+    recover, то и после сбоя с неизвестным исходом, но сначала вызывается
+    recover: он ищет результат прошлой попытки (например, файл по имени)
+    и возвращает его, а None - если запрос не выполнился и его можно повторить.
+
+    Args:
+        request: запрос API (HttpRequest или BatchHttpRequest).
+        api (str): 'sheets' или 'drive'.
+        cost (int): сколько запросов квоты расходует вызов (для пакетов - размер пакета).
+        idempotent (bool): можно ли повторять запрос после любой временной ошибки.
+        recover (callable, optional): проверка перед повтором неидемпотентного запроса.
+    """
+    for attempt in range(API_MAX_RETRIES + 1):
+        acquire_quota(api, cost)
+        try:
+            with client_pool.checkout() as http:
+                return request.execute(http=http)
+        except Exception as e:
+            rate_limited = isinstance(e, HttpError) and is_rate_limit_error(e)
+            retry = is_retryable_error(e) and (idempotent or rate_limited or recover is not None)
+            if not retry or attempt == API_MAX_RETRIES:
+                count_api_event(api, 'failed')
+                raise
+            if rate_limited:
+                count_api_event(api, 'throttled')
+            count_api_event(api, 'retried')
+            delay = backoff_delay(attempt)
+            if DEBUG_INFO: print(f"Повтор запроса к {api} через {delay:.1f} с: {e}")
+            time.sleep(delay)
+            if not idempotent and not rate_limited:
+                result = recover()
+                if result is not None:
+                    return result
+
+class GoogleBackend:
+    """
+    Данные в Google Sheets и на Google Drive: анкеты и маппинг - таблицы
+    Sheets, шаблоны и результаты - папки Drive. Те же методы, что у
+    LocalBackend (local_backend.py); запросы идут через execute_request
+    (квоты и повторы) на транспортах из client_pool (см. ClientPool).
+    """
+    def __init__(self, clients_spreadsheet_id, mapping_spreadsheet_id):
+        self.clients_spreadsheet_id = clients_spreadsheet_id
+        self.mapping_spreadsheet_id = mapping_spreadsheet_id
+        # Источник данных для снимка маппинга и состояния --watch
+        self.source = mapping_spreadsheet_id
+        
+    # --- Sheets ---
+    
+    def get_applicant_tabs(self):
+        """
+        Названия вкладок файла Clients_for_PDF (фамилии заявителей).
+        Запрашиваются только названия листов, без остальных свойств таблицы.
+        """
+        spreadsheet = execute_request(sheets_service.spreadsheets().get(
+            spreadsheetId=self.clients_spreadsheet_id,
+            fields='sheets.properties.title'
+        ), 'sheets')
+        return [sheet['properties']['title'] for sheet in spreadsheet.get('sheets', [])]
+        
+    def get_applicant_values(self, surname):
+        result = execute_request(sheets_service.spreadsheets().values().get(
+            spreadsheetId=self.clients_spreadsheet_id,
+            range=applicant_range(surname),  # Используем вкладку по фамилии заявителя
+            valueRenderOption='UNFORMATTED_VALUE',  # Получаем значения как есть
+            dateTimeRenderOption='FORMATTED_STRING'  # Даты - строкой в формате ячейки, а не серийным числом
+        ), 'sheets')
+        return result.get('values', [])
+        
+    def chunk_applicants(self, surnames):
+        """
+        Группы вкладок для одного batchGet: диапазоны передаются в URL,
+        поэтому группа ограничена длиной запроса (см. chunk_ranges)
+        """
+        range_to_surname = {applicant_range(surname): surname for surname in surnames}
+        return [[range_to_surname[cell_range] for cell_range in chunk] for chunk in chunk_ranges(list(range_to_surname))]
+        
+    def get_applicants_values(self, surnames):
+        """
+        Строки вкладок группы заявителей одним запросом values().batchGet
+        """
+        ranges = [applicant_range(surname) for surname in surnames]
+        result = execute_request(sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=self.clients_spreadsheet_id,
+            ranges=ranges,
+            valueRenderOption='UNFORMATTED_VALUE',  # Получаем значения как есть
+            dateTimeRenderOption='FORMATTED_STRING',  # Даты - строкой в формате ячейки, а не серийным числом
+            fields='valueRanges(values)'
+        ), 'sheets')
+        # valueRanges возвращаются в том же порядке, что и запрошенные диапазоны
+        return {surname: value_range.get('values', [])
+                for surname, value_range in zip(surnames, result.get('valueRanges', []))}
+                
+    def get_mapping_version(self):
+        """
+        Версия файла Mapping: modifiedTime и version с Drive
+        """
+        return execute_request(drive_service.files().get(
+            fileId=self.mapping_spreadsheet_id,
+            fields='modifiedTime, version'
+        ), 'drive')
+        
+    def get_mapping_values(self):
+        # Диапазон из одного названия листа - все заполненные строки и колонки
+        result = execute_request(sheets_service.spreadsheets().values().get(
+            spreadsheetId=self.mapping_spreadsheet_id,
+            range=MAPPING_SHEET_NAME
+        ), 'sheets')
+        return result.get('values', [])
+        
+    # --- Drive ---
+    
+    def iter_files(self, folder_id):
+        """
+        PDF-файлы папки (все страницы листинга)
+        """
+        return iter_drive_files(
+            f"'{folder_id}' in parents and mimeType='application/pdf' and trashed = false",
+            fields="id, name, md5Checksum, modifiedTime"
+        )
+        
+    def find_folder(self, folder_name, parent_folder_id):
+        # Формируем поисковый запрос: имя + тип "папка" + не в корзине
+        query = f"name = '{drive_query_literal(folder_name)}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+        
+        # Если указана родительская папка, добавляем условие
+        if parent_folder_id:
+            query += f" and '{parent_folder_id}' in parents"
+            
+        # Первая найденная папка, с переходом по страницам (если есть несколько с одинаковым именем)
+        folder = next(iter_drive_files(query, fields='id, name, mimeType, webViewLink', page_size=10, spaces='drive'), None)
+        return folder.get('id') if folder else None
+        
+    def create_folder(self, folder_name, parent_folder_id):
+        """
+        Возвращает ID папки folder_name, создавая ее при необходимости
+        """
+        folder_id = self.find_folder(folder_name, parent_folder_id)
+        if folder_id is None:
+            if DEBUG_INFO: print (f"Папка не существует. Создаем")
+            file_metadata = {
+                'name': folder_name,
+                'mimeType': 'application/vnd.google-apps.folder',
+                'parents': [parent_folder_id]
+            }
+            
+            def find_created():
+                # Папка могла быть создана попыткой, ответ на которую потерян
+                created_id = self.find_folder(folder_name, parent_folder_id)
+                return {'id': created_id} if created_id else None
+                
+            folder = execute_request(drive_service.files().create(body=file_metadata, fields='id'), 'drive',
+                                     idempotent=False, recover=find_created)
+            folder_id = folder.get('id')
+        return folder_id
+        
+    def resolve_folders(self, folder_names, parent_folder_id):
+        """
+        Находит или создает папки пакетными запросами: сначала один пакет поиска
+        на каждые DRIVE_BATCH_LIMIT папок, затем пакет создания для тех, что не
+        найдены. Возвращает имя папки -> ID или None, если папку получить не удалось.
+        """
+        folder_ids = {}
+        
+        lookups = []
+        for folder_name in folder_names:
+            query = (f"name = '{drive_query_literal(folder_name)}' and mimeType = 'application/vnd.google-apps.folder' "
+                     f"and trashed = false and '{parent_folder_id}' in parents")
+            lookups.append((folder_name, drive_service.files().list(q=query, spaces='drive', fields='files(id)', pageSize=1)))
+            
+        missing = []
+        for folder_name, (response, exception) in execute_drive_batch(lookups).items():
+            if exception is not None:
+                print(f"Ошибка при поиске папки {folder_name}: {exception}")
+                folder_ids[folder_name] = None
+            elif response.get('files'):
+                folder_ids[folder_name] = response['files'][0].get('id')
+            else:
+                missing.append(folder_name)
+                
+        if missing:
+            if DEBUG_INFO: print(f"Создаем папок: {len(missing)}")
+            creates = []
+            for folder_name in missing:
+                file_metadata = {
+                    'name': folder_name,
+                    'mimeType': 'application/vnd.google-apps.folder',
+                    'parents': [parent_folder_id]
+                }
+                creates.append((folder_name, drive_service.files().create(body=file_metadata, fields='id')))
+                
+            for folder_name, (response, exception) in execute_drive_batch(creates, idempotent=False).items():
+                if exception is not None and is_retryable_error(exception):
+                    # Исход создания неизвестен: create_folder сначала ищет папку и не создаст ее дважды
+                    try:
+                        folder_ids[folder_name] = self.create_folder(folder_name, parent_folder_id)
+                    except Exception as e:
+                        print(f"Ошибка при создании папки для {folder_name}: {e}")
+                        folder_ids[folder_name] = None
+                elif exception is not None:
+                    print(f"Ошибка при создании папки для {folder_name}: {exception}")
+                    folder_ids[folder_name] = None
+                else:
+                    folder_ids[folder_name] = response.get('id')
+                    
+        return folder_ids
+        
+    def download(self, file_id, destination):
+        from googleapiclient.http import MediaIoBaseDownload
+        request = drive_service.files().get_media(fileId=file_id)
+        # Пишем во временный файл, чтобы прерванное скачивание не оставило битый шаблон
+        tmp_destination = destination + '.part'
+        with open(tmp_destination, 'wb') as f, client_pool.checkout() as http:
+            # Используем MediaIoBaseDownload для потокового скачивания; части
+            # запрашиваются через транспорт запроса - на время скачивания он из пула
+            request.http = http
+            downloader = MediaIoBaseDownload(f, request)
+            execute_chunks(downloader.next_chunk, os.path.basename(destination), 'скачано')
+        os.replace(tmp_destination, destination)
+        
+    def upload(self, folder_id, file_name, data=None, file_path=None, file_id=None):
+        """
+        Загружает PDF в папку. Содержимое берется из data (байты в памяти),
+        а если data не передан - из файла file_path. Если указан file_id,
+        обновляется содержимое уже загруженного файла. Файлы больше
+        RESUMABLE_UPLOAD_THRESHOLD загружаются возобновляемой сессией частями
+        по UPLOAD_CHUNK_SIZE байт. Возвращает ID файла.
+        """
+        size = len(data) if data is not None else os.path.getsize(file_path)
+        resumable = size > RESUMABLE_UPLOAD_THRESHOLD
+        
+        def make_media():
+            from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+            if data is not None:
+                # Загрузка прямо из памяти, без временного файла на диске
+                return MediaIoBaseUpload(BytesIO(data), mimetype='application/pdf', chunksize=UPLOAD_CHUNK_SIZE, resumable=resumable)
+            return MediaFileUpload(file_path, mimetype='application/pdf', chunksize=UPLOAD_CHUNK_SIZE, resumable=resumable)
+            
+        if file_id:
+            # Файл уже загружался раньше - обновляем содержимое, ID сохраняется
+            try:
+                request = drive_service.files().update(fileId=file_id, media_body=make_media(), fields='id')
+                return execute_upload(request, file_name).get('id')
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                if DEBUG_INFO: print(f"Файл {file_name} удален с Drive, загружаем заново")
+                
+        file_metadata = {
+            'name': file_name,
+            'parents': [folder_id]
+        }
+        
+        def find_created():
+            # Файл мог быть создан попыткой, ответ на которую потерян: вместо второго
+            # файла с тем же именем обновляем найденный
+            created = next(iter_drive_files(f"name = '{drive_query_literal(file_name)}' and '{folder_id}' in parents "
+                                            "and trashed = false", fields='id', page_size=1), None)
+            if created is None:
+                return None
+            return {'id': self.upload(folder_id, file_name, data=data, file_path=file_path, file_id=created['id'])}
+            
+        request = drive_service.files().create(body=file_metadata, media_body=make_media(), fields='id')
+        return execute_upload(request, file_name, idempotent=False, recover=find_created).get('id')
+        
+    def get_start_page_token(self):
+        """
+        Текущая позиция ленты изменений Drive (changes.getStartPageToken)
+        """
+        return execute_request(drive_service.changes().getStartPageToken(), 'drive')['startPageToken']
+        
+    def list_changes(self, page_token):
+        """
+        Изменения файлов Drive, начиная с page_token (все страницы changes.list).
+        Returns: (изменения, новая позиция).
+        """
+        changes = []
+        while True:
+            result = execute_request(drive_service.changes().list(
+                pageToken=page_token,
+                pageSize=DRIVE_PAGE_SIZE,
+                spaces='drive',
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(name, parents, trashed))'
+            ), 'drive')
+            changes.extend(result.get('changes', []))
+            if 'newStartPageToken' in result:
+                return changes, result['newStartPageToken']
+            page_token = result['nextPageToken']
+
+# Источник данных - Google Sheets и Drive; при --local заменяется на LocalBackend (см. local_backend.py)
+backend = GoogleBackend(CLIENTS_SPREADSHEET_ID, MAPPING_SPREADSHEET_ID)
+
 # Функция для получения данных анкеты заявителя из отдельной вкладки
 def get_applicant_data(surname):
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=CLIENTS_SPREADSHEET_ID,
-            range=f"'{surname}'!A:B",  # Используем вкладку по фамилии заявителя
-            valueRenderOption='UNFORMATTED_VALUE'  # Получаем значения как есть
-        ).execute()
-        
-        values = result.get('values', [])
-        data_dict = {}
-        
-        for row in values:
-            if len(row) == 2:
-                field_name = row[1]   # Название поля в колонке B
-                field_value = row[0]  # Значение поля в колонке A
-                data_dict[field_name] = field_value
-                
-        return data_dict
+        return parse_applicant_rows(backend.get_applicant_values(surname))
     except Exception as e:
         print(f"Ошибка при получении данных для {surname}: {e}")
         return None
 
+def applicant_range(surname):
+    """
+    Диапазон A:B вкладки заявителя. Апострофы в названии вкладки удваиваются,
+    как того требует нотация A1.
+    """
+    escaped = surname.replace("'", "''")
+    return f"'{escaped}'!A:B"
+
+def parse_applicant_rows(values):
+    """
+    Превращает строки вкладки (значение в A, название в B) в словарь анкеты
+    """
+    data_dict = {}
+    
+    for row in values:
+        if len(row) == 2:
+            field_name = row[1]   # Название поля в колонке B
+            field_value = row[0]  # Значение поля в колонке A
+            data_dict[field_name] = field_value
+            
+    return data_dict
+
+def get_applicant_tabs():
+    """
+    Возвращает названия вкладок файла Clients_for_PDF (фамилии заявителей)
+    """
+    try:
+        return backend.get_applicant_tabs()
+    except Exception as e:
+        print(f"Ошибка при получении списка вкладок: {e}")
+        return None
+
+def chunk_ranges(ranges, max_url_chars=BATCH_GET_MAX_URL_CHARS):
+    """
+    Делит список диапазонов на группы так, чтобы строка запроса batchGet
+    (диапазоны передаются в URL) не превышала max_url_chars символов.
+    """
+    chunks = []
+    current = []
+    current_len = 0
+    
+    for cell_range in ranges:
+        # '&ranges=' + значение в URL-кодировке
+        range_len = len(quote(cell_range, safe='')) + 8
+        if current and current_len + range_len > max_url_chars:
+            chunks.append(current)
+            current = []
+            current_len = 0
+        current.append(cell_range)
+        current_len += range_len
+        
+    if current:
+        chunks.append(current)
+    return chunks
+
+def iter_applicant_chunks(surnames):
+    """
+    Генератор анкет группами: словарь {фамилия: анкета или None} на группу.
+
+    Группа читается одним запросом (для Sheets - values().batchGet, см.
+    GoogleBackend.chunk_applicants), поэтому число запросов к API зависит от
+    суммарной длины названий вкладок, а не от их количества. Если запрос
+    группы завершился ошибкой, вкладки этой группы загружаются по одной
+    через get_applicant_data.
+    """
+    for chunk in backend.chunk_applicants(surnames):
+        try:
+            applicants = {surname: parse_applicant_rows(values)
+                          for surname, values in backend.get_applicants_values(chunk).items()}
+        except Exception as e:
+            print(f"Ошибка при пакетном получении данных ({len(chunk)} вкладок): {e}")
+            applicants = {surname: get_applicant_data(surname) for surname in chunk}
+        yield applicants
+
 # Функция для получения маппинга полей из файла Mapping
-def get_mapping():
+def get_mapping_version():
+    """
+    Версия файла Mapping: modifiedTime и version с Drive (для локального
+    каталога - время изменения файла). None, если узнать не удалось.
+    """
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=MAPPING_SPREADSHEET_ID,
-            range='Map!A:Z'  # Используем правильное название листа
-        ).execute()
-        
-        values = result.get('values', [])
-        if not values:
-            return {}
-            
-        # Первая строка - названия шаблонов (начиная с колонки B)
-        template_names = []
-        if len(values[0]) > 1:
-            template_names = [cell.strip() for cell in values[0][1:]]
-            
-        mapping = {template: {} for template in template_names}
-
-        if DEBUG_INFO:
-            print("Шаблоны в файле Mapping:")
-            for i, name in enumerate(template_names, start=1):
-                print(f"{i}. {name}")
-        
-        # Остальные строки - соответствия полей
-        for row in values[1:]:
-            if len(row) > 0:
-                sheet_field = row[0].strip()  # Название поля из анкеты Google Sheets
+        return backend.get_mapping_version()
+    except Exception as e:
+        print(f"Ошибка при получении версии маппинга: {e}")
+        return None
+
+def load_mapping_snapshot(source, version, path=None):
+    """
+    Сохраненный разбор маппинга, если он сделан для той же версии файла Mapping
+    """
+    if version is None:
+        return None
+    snapshot = load_json(path or MAPPING_SNAPSHOT_PATH)
+    if not snapshot or snapshot.get('source') != source or snapshot.get('version') != version:
+        return None
+    return snapshot.get('mapping')
+
+def save_mapping_snapshot(source, version, mapping, path=None):
+    # Порядок шаблонов и полей важен (первое соответствие выигрывает) - ключи не сортируем
+    save_json_atomic(path or MAPPING_SNAPSHOT_PATH, {'source': source, 'version': version, 'mapping': mapping})
+
+def parse_mapping_rows(values):
+    """
+    Разбирает строки листа Map: {шаблон: {поле анкеты: ячейка с полем PDF}}
+    """
+    if not values:
+        return {}
+        
+    # Первая строка - названия шаблонов (начиная с колонки B)
+    template_names = []
+    if len(values[0]) > 1:
+        template_names = [cell.strip() for cell in values[0][1:]]
+        
+    mapping = {template: {} for template in template_names}
+
+    if DEBUG_INFO:
+        print("Шаблоны в файле Mapping:")
+        for i, name in enumerate(template_names, start=1):
+            print(f"{i}. {name}")
+    
+    # Остальные строки - соответствия полей
+    previous_field = None
+    for row in values[1:]:
+        if len(row) > 0:
+            sheet_field = row[0].strip()  # Название поля из анкеты Google Sheets
+            
+            # Специальные строки #DAY/#MONTH/#YEAR относятся к полю анкеты строкой выше;
+            # в маппинге они хранятся под ключом "поле#DAY" (см. split_sheet_key)
+            if sheet_field in DATE_PART_MARKERS:
+                if previous_field is None:
+                    print(f"Строка {sheet_field} в маппинге без поля анкеты выше. Пропуск.")
+                    continue
+                sheet_field = previous_field + sheet_field
+            else:
+                previous_field = sheet_field
                 
-                # Проверка на специальную строку #DAY
-                if sheet_field == "#DAY":
-                    continue  # Обработка будет при заполнении форм
+            # Соответствия для каждого шаблона
+            for i, template in enumerate(template_names):
+                if len(row) > i + 1 and row[i + 1].strip():
+                    pdf_field = row[i + 1].strip()
+                    mapping[template][sheet_field] = pdf_field
+                    # if DEBUG_INFO:  print(f"{template}.{sheet_field}=>{pdf_field}")
                     
-                # Соответствия для каждого шаблона
-                for i, template in enumerate(template_names):
-                    if len(row) > i + 1 and row[i + 1].strip():
-                        pdf_field = row[i + 1].strip()
-                        mapping[template][sheet_field] = pdf_field
-                        # if DEBUG_INFO:  print(f"{template}.{sheet_field}=>{pdf_field}")
-                        
+    return mapping
+
+def get_mapping():
+    """
+    Маппинг полей из листа Map файла Mapping. Лист читается целиком, без
+    ограничения по колонкам. Разобранный маппинг сохраняется локально вместе
+    с версией файла; пока файл на Drive не изменился, лист не запрашивается.
+    """
+    try:
+        source = backend.source
+        version = get_mapping_version()
+        mapping = load_mapping_snapshot(source, version)
+        if mapping is not None:
+            if DEBUG_INFO: print(f"Маппинг не изменился с прошлого запуска - используется сохраненный снимок ({len(mapping)} шаблонов)")
+            return mapping
+            
+        mapping = parse_mapping_rows(backend.get_mapping_values())
+        if mapping and version is not None:
+            save_mapping_snapshot(source, version, mapping)
         return mapping
     except Exception as e:
         print(f"Ошибка при получении маппинга: {e}")
         return None
 
-# Функция для получения списка файлов в папке Google Drive
-def list_files_in_folder(folder_id):
+# Функция для получения списка файлов в папке Google Drive
+def iter_drive_files(query, fields='id, name', page_size=None, **list_kwargs):
+    """
+    Генератор файлов Drive по запросу q с переходом по nextPageToken.
+    Файлы выдаются по мере получения страниц, поэтому обработка может
+    начинаться до окончания листинга.
+
+    Args:
+        query (str): запрос q для files().list.
+        fields (str): поля файла, которые нужно получить.
+        page_size (int, optional): размер страницы (по умолчанию DRIVE_PAGE_SIZE).
+    """
+    page_token = None
+    while True:
+        results = execute_request(drive_service.files().list(
+            q=query,
+            fields=f"nextPageToken, files({fields})",
+            pageSize=page_size or DRIVE_PAGE_SIZE,
+            pageToken=page_token,
+            **list_kwargs
+        ), 'drive')
+        
+        # Страница может быть пустой, даже если за ней есть еще
+        yield from results.get('files', [])
+        
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+def iter_files_in_folder(folder_id):
+    """
+    Генератор PDF-файлов папки Drive (все страницы листинга). Ошибка на любой
+    странице выбрасывается: по неполному листингу нельзя судить о составе папки.
+    """
+    yield from backend.iter_files(folder_id)
+
+# Функция для получения списка файлов в папке Google Drive
+def list_files_in_folder(folder_id):
+    return list(iter_files_in_folder(folder_id))
+
+def resolve_mapping_key(template_name, mapping, fuzzy=False):
+    """
+    Колонка Mapping для шаблона: колонка с точно таким же именем, как у файла.
+    С fuzzy=True, если такой нет, ищется имя без расширения, затем то же без
+    учета регистра, затем нечеткое совпадение: имя шаблона без расширения
+    содержится в названии колонки или наоборот (без учета регистра).
+    Из нескольких нечетких кандидатов выбирается самый длинный, при равной
+    длине - первый по алфавиту, чтобы выбор не зависел от порядка колонок.
+    Возвращает None, если колонки нет.
+    """
+    if template_name in mapping:
+        return template_name
+    if not fuzzy:
+        return None
+        
+    base_template_name = os.path.splitext(template_name)[0]
+    if base_template_name in mapping:
+        return base_template_name
+        
+    base_lower = base_template_name.lower()
+    exact_ignore_case = sorted(key for key in mapping if key.lower() in (template_name.lower(), base_lower))
+    if exact_ignore_case:
+        return exact_ignore_case[0]
+        
+    candidates = [key for key in mapping if key and (base_lower in key.lower() or key.lower() in base_lower)]
+    if not candidates:
+        return None
+    chosen = min(candidates, key=lambda key: (-len(key), key))
+    if len(candidates) > 1:
+        print(f"Для шаблона {template_name} подходят колонки Mapping {candidates}, выбрана '{chosen}'")
+    return chosen
+
+def filter_mapped_templates(template_files, mapping, found=None, resolved=None, fuzzy=False):
+    """
+    Пропускает только шаблоны, для которых есть колонка в Mapping (см. resolve_mapping_key;
+    нечеткое совпадение - только с fuzzy=True).
+    Если передан список found, в него добавляются все просмотренные файлы;
+    в словарь resolved записывается выбранная колонка: имя шаблона -> ключ маппинга.
+    """
+    for tmpl in template_files:
+        if found is not None:
+            found.append(tmpl)
+        print (f"Шаблон - {tmpl['name']}")
+        mapping_key = resolve_mapping_key(tmpl['name'], mapping, fuzzy)
+        if mapping_key is not None:
+            if resolved is not None:
+                resolved[tmpl['name']] = mapping_key
+            yield tmpl
+        else:
+            print (f"Не берем этот шаблон - его нет в Mapping")
+
+def check_folder_exists_by_name(folder_name, parent_folder_id=None):
+    """
+    Проверяет, существует ли папка с заданным именем в Google Drive.
+
+    Args:
+        folder_name (str): Имя папки для поиска.
+        parent_folder_id (str, optional): ID родительской папки для поиска.
+                                          Если None, поиск идет по всему диску.
+
+    Returns:
+        str: ID первой найденной папки или None, если папка не найдена
+             или произошла ошибка.
+    """
+    try:
+        return backend.find_folder(folder_name, parent_folder_id)
+    except Exception as error:
+        print(f"Произошла ошибка при обращении к Drive API: {error}")
+        return None
+
+# Функция для создания подпапки для заявителя в Google Drive
+def create_applicant_folder(folder_name, parent_folder_id):
+    try:
+        return backend.create_folder(folder_name, parent_folder_id)
+    except Exception as e:
+        print(f"Ошибка при создании папки для {folder_name}: {e}")
+        return None
+
+def drive_query_literal(value):
+    """
+    Экранирует строку для подстановки в запрос q Drive API ('...')
+    """
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def execute_drive_batch(requests, idempotent=True):
+    """
+    Выполняет запросы Drive API пакетами (new_batch_http_request) по
+    DRIVE_BATCH_LIMIT запросов в одном HTTP-запросе.
+
+    Args:
+        requests (list): пары (ключ, запрос Drive API).
+        idempotent (bool): False для запросов создания - они повторяются только
+                           после отказа по лимиту (см. execute_request).
+
+    Returns:
+        dict: ключ -> (ответ, исключение); для успешных запросов исключение None.
+    """
+    results = {}
+    pending = list(requests)
+    
+    for attempt in range(API_MAX_RETRIES + 1):
+        retry = []
+        for start in range(0, len(pending), DRIVE_BATCH_LIMIT):
+            chunk = pending[start:start + DRIVE_BATCH_LIMIT]
+            
+            def callback(request_id, response, exception, chunk=chunk):
+                # request_id - позиция запроса в пачке, по ней находим ключ
+                results[chunk[int(request_id)][0]] = (response, exception)
+                
+            batch = drive_service.new_batch_http_request(callback=callback)
+            for i, (_, request) in enumerate(chunk):
+                batch.add(request, request_id=str(i))
+            try:
+                # Каждый запрос пакета расходует квоту отдельно
+                execute_request(batch, 'drive', cost=len(chunk), idempotent=idempotent)
+            except Exception as e:
+                for key, _ in chunk:
+                    results.setdefault(key, (None, e))
+                    
+            # Элементы пакета, отклоненные по лимиту или из-за сбоя сервера, повторяем отдельным пакетом
+            for key, request in chunk:
+                exception = results.get(key, (None, None))[1]
+                if exception is None or not isinstance(exception, HttpError):
+                    continue
+                if is_rate_limit_error(exception) or (idempotent and is_retryable_error(exception)):
+                    retry.append((key, request))
+                    
+        if not retry or attempt == API_MAX_RETRIES:
+            break
+        count_api_event('drive', 'retried', len(retry))
+        if any(is_rate_limit_error(results[key][1]) for key, _ in retry):
+            count_api_event('drive', 'throttled')
+        for key, _ in retry:
+            del results[key]
+        pending = retry
+        time.sleep(backoff_delay(attempt))
+        
+    return results
+
+def resolve_applicant_folders(folder_names, parent_folder_id):
+    """
+    Находит или создает папки заявителей в parent_folder_id (на Drive -
+    пакетными запросами, см. GoogleBackend.resolve_folders).
+
+    Returns:
+        dict: имя папки -> ID папки или None, если папку получить не удалось.
+    """
+    try:
+        return backend.resolve_folders(folder_names, parent_folder_id)
+    except Exception as e:
+        print(f"Ошибка при получении папок заявителей: {e}")
+        return dict.fromkeys(folder_names)
+
+# Функция для скачивания файла с Google Drive
+def download_file(file_id, destination):
+    try:
+        backend.download(file_id, destination)
+        return True
+    except Exception as e:
+        print(f"Ошибка при скачивании файла: {e}")
+        return False
+
+def load_template_index(directory='templates'):
+    """
+    Индекс локального кэша шаблонов: имя -> {id, md5Checksum, modifiedTime}
+    """
+    return load_json(os.path.join(directory, TEMPLATE_INDEX_FILE)) or {}
+
+def save_template_index(index, directory='templates'):
+    save_json_atomic(os.path.join(directory, TEMPLATE_INDEX_FILE), index, sort_keys=True)
+
+def is_template_cached(index, file, local_path):
+    """
+    True, если локальная копия совпадает с файлом на Drive по md5Checksum и modifiedTime
+    """
+    entry = index.get(file['name'])
+    return bool(
+        entry
+        and os.path.exists(local_path)
+        and entry.get('id') == file['id']
+        and entry.get('md5Checksum') == file.get('md5Checksum')
+        and entry.get('modifiedTime') == file.get('modifiedTime')
+    )
+
+def sync_templates(template_files, directory='templates', max_workers=None, stats=None):
+    """
+    Приводит локальный кэш шаблонов в соответствие с Drive: скачиваются только
+    новые и измененные шаблоны, причем параллельно. template_files может быть
+    генератором (iter_files_in_folder) - скачивание начинается сразу по мере
+    поступления файлов, не дожидаясь конца листинга.
+
+    Args:
+        template_files (iterable): файлы с Drive (с md5Checksum и modifiedTime).
+        directory (str): папка локального кэша.
+        max_workers (int, optional): число потоков скачивания.
+        stats (dict, optional): сюда записываются cached, downloaded и downloaded_bytes.
+
+    Returns:
+        dict: имя шаблона -> локальный путь (только успешно полученные шаблоны).
+
+    Ошибка листинга выбрасывается после завершения начатых скачиваний; индекс
+    кэша при этом не сохраняется, чтобы не потерять записи о шаблонах, до
+    которых листинг не дошел.
+    """
+    max_workers = max_workers or TEMPLATE_DOWNLOAD_WORKERS
+    index = load_template_index(directory)
+    listed = []
+    template_paths = {}
+    downloads = []
+    
+    def download(file, local_path):
+        return download_file(file['id'], local_path)
+        
+    # Скачивания идут в потоках пула, но их запросы относятся к этапу вызывающего потока
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=adopt_stage, initargs=(current_stage(),)) as executor:
+        for file in template_files:
+            template_name = file['name']
+            if not template_name.endswith('.pdf'):
+                continue
+            listed.append(file)
+            local_path = os.path.join(directory, template_name)
+            if is_template_cached(index, file, local_path):
+                template_paths[template_name] = local_path
+            else:
+                downloads.append((file, local_path, executor.submit(download, file, local_path)))
+                
+        if DEBUG_INFO: print(f"Шаблонов в локальном кэше: {len(template_paths)}, к скачиванию: {len(downloads)}")
+        
+        cached = len(template_paths)
+        downloaded_bytes = 0
+        for file, local_path, future in downloads:
+            if future.result():
+                template_paths[file['name']] = local_path
+                downloaded_bytes += os.path.getsize(local_path)
+                
+    if stats is not None:
+        stats['cached'] = cached
+        stats['downloaded'] = len(template_paths) - cached
+        stats['downloaded_bytes'] = downloaded_bytes
+                
+    new_index = {}
+    for file in listed:
+        if file['name'] in template_paths:
+            new_index[file['name']] = {key: file.get(key) for key in ('id', 'md5Checksum', 'modifiedTime')}
+    save_template_index(new_index, directory)
+    
+    # Порядок шаблонов - как в листинге Drive
+    return {file['name']: template_paths[file['name']] for file in listed if file['name'] in template_paths}
+
+# Функция для загрузки PDF в Google Drive
+def execute_chunks(next_chunk, file_name, action):
+    """
+    Передает файл частями: next_chunk возобновляемой загрузки
+    (HttpRequest.next_chunk) или скачивания (MediaIoBaseDownload.next_chunk)
+    вызывается до завершения, с квотой, счетчиками api_stats и выводом
+    прогресса. При обрыве соединения или ошибке сервера передача продолжается
+    с последней принятой части, а не с начала файла.
+
+    Returns:
+        второй элемент результата next_chunk: ответ API для загрузки, True для скачивания.
+    """
+    import httplib2
+    result = None
+    failures = 0
+    while result is None or result is False:
+        try:
+            acquire_quota('drive')
+            status, result = next_chunk()
+            failures = 0
+            if status and DEBUG_INFO:
+                print(f"  {file_name}: {action} {int(status.progress() * 100)}%")
+        except (HttpError, OSError, httplib2.HttpLib2Error) as e:
+            if not is_retryable_error(e):
+                count_api_event('drive', 'failed')
+                raise
+            failures += 1
+            if failures > UPLOAD_RESUME_ATTEMPTS:
+                count_api_event('drive', 'failed')
+                raise
+            if isinstance(e, HttpError) and is_rate_limit_error(e):
+                count_api_event('drive', 'throttled')
+            count_api_event('drive', 'retried')
+            if DEBUG_INFO: print(f"  {file_name}: обрыв передачи ({e}), продолжаем с последней принятой части")
+            time.sleep(backoff_delay(failures))
+    return result
+
+def execute_upload(request, file_name, idempotent=True, recover=None):
+    """
+    Выполняет запрос загрузки. Возобновляемая загрузка передается частями
+    (см. execute_chunks) и повторов не боится: сессия создает файл один раз.
+    Обычная - одним запросом через execute_request; для создания файла
+    idempotent и recover передаются туда же.
+    """
+    if not request.resumable:
+        return execute_request(request, 'drive', idempotent=idempotent, recover=recover)
+    with client_pool.checkout() as http:
+        return execute_chunks(partial(request.next_chunk, http=http), file_name, 'загружено')
+
+def upload_pdf_to_drive(file_path, folder_id, file_name, file_id=None, data=None):
+    """
+    Загружает PDF в папку (см. GoogleBackend.upload): из data (байты в памяти)
+    или из файла file_path; при указанном file_id обновляется этот файл.
+    Возвращает ID файла или None при ошибке.
+    """
+    try:
+        return backend.upload(folder_id, file_name, data=data, file_path=file_path, file_id=file_id)
+    except Exception as e:
+        print(f"Ошибка при загрузке файла: {e}")
+        return None
+
+def content_hash(value):
+    """
+    SHA-256 от JSON-представления значения (ключи словарей сортируются)
+    """
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def file_hash(path):
+    """
+    SHA-256 содержимого файла
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(path=None):
+    """
+    Загружает манифест результатов: ключ "заявитель/шаблон" -> хэши входных
+    данных (анкета, колонка маппинга, шаблон) и ID файла на Drive.
+    """
+    path = path or MANIFEST_PATH
+    manifest = load_json(path)
+    if manifest is None and os.path.exists(path):
+        print("Манифест не прочитан - все формы будут сформированы заново.")
+    return manifest or {}
+
+def save_manifest(manifest, path=None):
+    """
+    Сохраняет манифест атомарно, чтобы прерванный запуск не оставил его поврежденным
+    """
+    save_json_atomic(path or MANIFEST_PATH, manifest, sort_keys=True)
+
+def manifest_key(surname, template_name):
+    return f"{surname}/{template_name}"
+
+def is_output_current(manifest, key, input_hashes):
+    """
+    True, если результат уже загружен и ни один из входов не изменился
+    """
+    entry = manifest.get(key)
+    return bool(entry and entry.get('file_id') and entry.get('inputs') == input_hashes)
+
+def can_update_incrementally(manifest, key, input_hashes):
+    """
+    True, если предыдущий результат можно дополнить инкрементальным обновлением:
+    он загружен, известен хэш его содержимого, а шаблон и колонка маппинга
+    не менялись (изменились только данные анкеты). При смене шаблона или
+    маппинга форма формируется заново.
+    """
+    entry = manifest.get(key)
+    if not (entry and entry.get('file_id') and entry.get('output')):
+        return False
+    inputs = entry.get('inputs', {})
+    return inputs.get('template') == input_hashes['template'] and inputs.get('mapping') == input_hashes['mapping']
+
+def previous_output_path(output_filename, directory=None):
+    return os.path.join(directory or PREVIOUS_OUTPUTS_DIR, output_filename)
+
+def fetch_previous_outputs(jobs, directory=None, max_workers=None):
+    """
+    Готовит локальные копии предыдущих результатов для инкрементальных заданий
+    (с ключом previous_hash). Копия, совпадающая с манифестом по хэшу,
+    используется как есть, иначе файл скачивается с Drive. Заданию проставляется
+    previous_path; если копию получить не удалось или файл на Drive изменен
+    вручную, previous_path = None и форма формируется заново.
+
+    Returns:
+        int: число скачанных байт.
+    """
+    directory = directory or PREVIOUS_OUTPUTS_DIR
+    max_workers = max_workers or TEMPLATE_DOWNLOAD_WORKERS
+    os.makedirs(directory, exist_ok=True)
+    downloads = []
+    
+    def download(job, local_path):
+        return download_file(job['file_id'], local_path)
+        
+    # Скачивания идут в потоках пула, но их запросы относятся к этапу вызывающего потока
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=adopt_stage, initargs=(current_stage(),)) as executor:
+        for job in jobs:
+            if not job.get('previous_hash'):
+                continue
+            local_path = previous_output_path(job['output_filename'], directory)
+            if os.path.exists(local_path) and file_hash(local_path) == job['previous_hash']:
+                job['previous_path'] = local_path
+            else:
+                downloads.append((job, local_path, executor.submit(download, job, local_path)))
+                
+        downloaded_bytes = 0
+        for job, local_path, future in downloads:
+            job['previous_path'] = None
+            if not future.result():
+                continue
+            downloaded_bytes += os.path.getsize(local_path)
+            if file_hash(local_path) == job['previous_hash']:
+                job['previous_path'] = local_path
+            else:
+                print(f"Файл {job['output_filename']} на Drive изменен после последней загрузки - форма будет сформирована заново.")
+                
+    return downloaded_bytes
+
+class TemplateCache:
+    """
+    Кэш разобранных PDF-шаблонов в памяти, ключ - имя шаблона.
+
+    Для каждого шаблона хранятся байты файла и PdfReader над ними. Все
+    объекты PDF разбираются ридером один раз при загрузке шаблона, а каждое
+    заполнение получает свой PdfWriter-клон из уже разобранных объектов -
+    без чтения файла и повторного разбора. pypdf не гарантирует безопасность
+    одновременных обращений к одному ридеру, поэтому клоны одного шаблона
+    создаются по очереди (блокировка шаблона), а разных - параллельно.
+    Объем кэша ограничен max_bytes (оценка: размер файла * MEMORY_FACTOR);
+    при переполнении вытесняются давно не использованные шаблоны.
+    """
+    # Во сколько раз разобранный граф объектов больше исходного файла (оценка)
+    MEMORY_FACTOR = 4
+    
+    def __init__(self, max_bytes=None):
+        self.max_bytes = TEMPLATE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._entries = OrderedDict()  # имя -> (байты, PdfReader, оценка размера, блокировка шаблона)
+        self._size = 0
+        self._lock = threading.Lock()
+        
+    def _load(self, template_name, template_path):
+        from pypdf import PdfReader
+        from pypdf.generic import IndirectObject
+        with open(template_path, 'rb') as template_file:
+            data = template_file.read()
+        reader = PdfReader(BytesIO(data))
+        # Разбираем все объекты из таблицы xref (и из объектных потоков) и дерево
+        # страниц сейчас: клоны берут объекты из кэша ридера, не обращаясь к парсеру
+        for generation, offsets in list(reader.xref.items()):
+            for idnum in list(offsets):
+                reader.get_object(IndirectObject(idnum, generation, reader))
+        for idnum in list(reader.xref_objStm):
+            reader.get_object(idnum)
+        len(reader.pages)
+        return data, reader, len(data) * self.MEMORY_FACTOR, threading.Lock()
+        
+    def _get_entry(self, template_name, template_path):
+        with self._lock:
+            entry = self._entries.get(template_name)
+            if entry is not None:
+                self._entries.move_to_end(template_name)
+                return entry
+                
+            entry = self._load(template_name, template_path)
+            cost = entry[2]
+            if cost > self.max_bytes:
+                # Шаблон больше всего кэша - используем без сохранения
+                return entry
+                
+            while self._entries and self._size + cost > self.max_bytes:
+                _, (_, _, evicted_cost, _) = self._entries.popitem(last=False)
+                self._size -= evicted_cost
+                
+            self._entries[template_name] = entry
+            self._size += cost
+            return entry
+            
+    def get_writer(self, template_name, template_path):
+        """
+        Возвращает новый PdfWriter - клон шаблона для одного заполнения
+        """
+        from pypdf import PdfWriter
+        _, reader, _, template_lock = self._get_entry(template_name, template_path)
+        with template_lock:
+            return PdfWriter(clone_from=reader)
+            
+    def get_fields(self, template_name, template_path):
+        """
+        Возвращает список имен полей формы шаблона
+        """
+        _, reader, _, template_lock = self._get_entry(template_name, template_path)
+        with template_lock:
+            fields = reader.get_fields()
+        return list(fields.keys()) if fields else []
+        
+    def get_widgets(self, template_name, template_path):
+        """
+        Возвращает индекс виджетов формы шаблона (см. index_form_widgets)
+        """
+        _, reader, _, template_lock = self._get_entry(template_name, template_path)
+        with template_lock:
+            return index_form_widgets(reader)
+
+def read_template_fields(template_path, template_cache=None):
+    """
+    Возвращает список имен полей формы, которые есть в шаблоне
+    """
+    try:
+        if template_cache is not None:
+            return template_cache.get_fields(os.path.basename(template_path), template_path)
+        from pypdf import PdfReader
+        fields = PdfReader(template_path).get_fields()
+        return list(fields.keys()) if fields else []
+    except Exception as e:
+        print(f"Ошибка при чтении полей шаблона {template_path}: {e}")
+        return []
+
+def qualified_field_name(field):
+    """
+    Полное имя поля формы: /T поля и его родителей через точку (как в get_fields)
+    """
+    parts = []
+    while field is not None:
+        if '/T' in field:
+            parts.append(str(field['/T']))
+        field = field.get('/Parent')
+        field = field.get_object() if field is not None else None
+    return '.'.join(reversed(parts))
+
+def inherited_field_value(field, key, default=None):
+    while field is not None:
+        if key in field:
+            return field[key]
+        field = field.get('/Parent')
+        field = field.get_object() if field is not None else None
+    return default
+
+def index_form_widgets(pdf):
+    """
+    Индекс виджетов формы за один проход по страницам: полное имя поля ->
+    тип (/FT), флаги (/Ff), /MaxLen, состояния кнопки из /AP и расположение
+    виджетов (номер страницы, номер в /Annots). Клоны шаблона и ранее
+    сформированные по нему файлы сохраняют порядок страниц и аннотаций,
+    поэтому индекс шаблона подходит для них без повторного сканирования.
+
+    Args:
+        pdf: PdfReader или PdfWriter.
+    """
+    widgets = {}
+    for page_index, page in enumerate(pdf.pages):
+        for annot_index, annot in enumerate(page.get('/Annots') or ()):
+            annot = annot.get_object()
+            if annot.get('/Subtype') != '/Widget':
+                continue
+            # Виджет без /T - часть поля-родителя (например, вариант переключателя)
+            field = annot if '/T' in annot else annot.get('/Parent')
+            if field is None:
+                continue
+            field = field.get_object()
+            entry = widgets.get(qualified_field_name(field))
+            if entry is None:
+                max_len = inherited_field_value(field, '/MaxLen')
+                entry = widgets[qualified_field_name(field)] = {
+                    'type': str(inherited_field_value(field, '/FT', '')),
+                    'flags': int(inherited_field_value(field, '/Ff', 0)),
+                    'max_len': int(max_len) if max_len is not None else None,
+                    'states': [],
+                    'locations': [],
+                }
+            entry['locations'].append((page_index, annot_index))
+            if entry['type'] == '/Btn':
+                normal_appearance = annot.get('/AP', {}).get('/N', {})
+                entry['states'].extend(str(state) for state in normal_appearance
+                                       if state != '/Off' and str(state) not in entry['states'])
+    return widgets
+
+def read_template_widgets(template_path, template_cache=None):
+    """
+    Возвращает индекс виджетов формы шаблона (см. index_form_widgets)
+    """
+    try:
+        if template_cache is not None:
+            return template_cache.get_widgets(os.path.basename(template_path), template_path)
+        from pypdf import PdfReader
+        return index_form_widgets(PdfReader(template_path))
+    except Exception as e:
+        print(f"Ошибка при чтении виджетов шаблона {template_path}: {e}")
+        return {}
+
+def split_sheet_key(sheet_key):
+    """
+    Ключ маппинга -> (поле анкеты, маркер части даты или None)
+    """
+    for marker in DATE_PART_MARKERS:
+        if sheet_key.endswith(marker):
+            return sheet_key[:-len(marker)], marker
+    return sheet_key, None
+
+def parse_mapping_cell(cell):
+    """
+    Ячейка маппинга "поле PDF|модификатор|..." -> (поле PDF, [модификаторы])
+    """
+    pdf_field, *modifiers = cell.split(MAPPING_MODIFIER_SEPARATOR)
+    return pdf_field.strip(), [modifier.strip() for modifier in modifiers if modifier.strip()]
+
+def serial_to_date(value):
+    """
+    Дата из серийного номера Sheets (число или строка с числом) или None
+    """
+    try:
+        return (SHEETS_EPOCH + timedelta(days=float(value))).date()
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def mapping_date_fields(mapping):
+    """
+    Поля анкеты, которые в маппинге используются как даты
+    """
+    date_fields = set()
+    for template_mapping in mapping.values():
+        for sheet_key, cell in template_mapping.items():
+            sheet_field, marker = split_sheet_key(sheet_key)
+            _, modifiers = parse_mapping_cell(cell)
+            if marker or any(modifier.split(':', 1)[0] in ('date', 'day', 'month', 'year') for modifier in modifiers):
+                date_fields.add(sheet_field)
+    return date_fields
+
+def normalize_serial_dates(data_dict, date_fields):
+    """
+    Переводит серийные номера дат в полях date_fields в ISO-строки (ГГГГ-ММ-ДД).
+    Выполняется один раз на заявителя, до заполнения всех его шаблонов.
+    """
+    normalized = dict(data_dict)
+    for field_name in date_fields:
+        field_value = normalized.get(field_name)
+        if isinstance(field_value, str) and not field_value.strip().replace('.', '', 1).isdigit():
+            continue
+        date_value = serial_to_date(field_value)
+        if date_value is not None:
+            normalized[field_name] = date_value.isoformat()
+    return normalized
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    """
+    Разбирает дату из значения анкеты по DATE_INPUT_FORMATS; None, если не удалось
+    """
+    value = str(value).strip()
+    for date_format in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return None
+
+# Преобразования значений - функции модуля (через partial), чтобы план заполнения
+# можно было передать в процесс пула
+def date_part(value, part):
+    date_value = parse_date(value)
+    # Если дату не удалось распарсить, оставляем значение как есть
+    return str(getattr(date_value, part)) if date_value else value
+
+def format_date(value, date_format):
+    date_value = parse_date(value)
+    return date_value.strftime(date_format) if date_value else value
+
+def upper_text(value):
+    return str(value).upper()
+
+def lower_text(value):
+    return str(value).lower()
+
+def truncate_text(value, max_len):
+    return str(value)[:max_len]
+
+def compile_value_transforms(marker, modifiers):
+    """
+    Цепочка преобразований для маркера части даты и модификаторов ячейки маппинга:
+    day, month, year, date:<формат strftime>, upper, lower
+    """
+    chain = []
+    if marker:
+        chain.append(partial(date_part, part=DATE_PART_MARKERS[marker]))
+    for modifier in modifiers:
+        name, _, argument = modifier.partition(':')
+        if name in ('day', 'month', 'year'):
+            chain.append(partial(date_part, part=name))
+        elif name == 'date' and argument:
+            chain.append(partial(format_date, date_format=argument))
+        elif name == 'upper':
+            chain.append(upper_text)
+        elif name == 'lower':
+            chain.append(lower_text)
+        else:
+            print(f"Неизвестный модификатор в маппинге: '{modifier}'. Пропуск.")
+    return chain
+
+def compile_fill_plan(template_mapping, pdf_fields, transforms=None, widgets=None):
+    """
+    Компилирует план заполнения одного шаблона. Строится один раз за запуск
+    и переиспользуется для всех заявителей.
+
+    Args:
+        template_mapping (dict): колонка маппинга шаблона {поле анкеты: поле PDF};
+                                 ключ может нести маркер части даты ("поле#DAY"),
+                                 ячейка - модификаторы ("поле PDF|upper").
+        pdf_fields (list): имена полей, которые реально есть в шаблоне.
+        transforms (dict, optional): {поле PDF: [функция, ...]} - дополнительные
+                                     преобразования значения перед записью в поле.
+        widgets (dict, optional): индекс виджетов шаблона (index_form_widgets);
+                                  по нему значения обрезаются до /MaxLen.
+
+    Returns:
+        dict: 'reverse'    - обратный индекс {поле PDF: поле анкеты};
+              'fields'     - поля шаблона, для которых есть соответствие в маппинге;
+              'transforms' - {поле PDF: кортеж функций} для полей из 'fields';
+              'widgets'    - виджеты полей из 'fields' (для write_field_values).
+    """
+    if widgets is None:
+        widgets = {}
+    if transforms is None:
+        transforms = {}
+        
+    reverse = {}
+    chains = {}
+    for sheet_key, cell in template_mapping.items():
+        pdf_field, modifiers = parse_mapping_cell(cell)
+        # Как и при линейном поиске, выигрывает первое соответствие
+        if pdf_field in reverse:
+            continue
+        sheet_field, marker = split_sheet_key(sheet_key)
+        reverse[pdf_field] = sheet_field
+        chains[pdf_field] = compile_value_transforms(marker, modifiers)
+        
+    fields = [field_name for field_name in pdf_fields if field_name in reverse]
+    
+    compiled_transforms = {}
+    for field_name in fields:
+        chain = chains[field_name] + list(transforms.get(field_name, ()))
+        max_len = widgets.get(field_name, {}).get('max_len')
+        if max_len and widgets[field_name]['type'] == '/Tx':
+            chain.append(partial(truncate_text, max_len=max_len))
+        compiled_transforms[field_name] = tuple(chain)
+        
+    return {
+        'reverse': reverse,
+        'fields': fields,
+        'transforms': compiled_transforms,
+        'widgets': {field_name: widgets[field_name] for field_name in fields if field_name in widgets},
+    }
+
+def resolve_field_value(fill_plan, field_name, data_dict):
+    """
+    Значение поля PDF по плану заполнения: одна выборка из обратного индекса
+    и цепочка преобразований. Возвращает None, если данных для поля нет.
+    """
+    sheet_field_name = fill_plan['reverse'].get(field_name)
+    if sheet_field_name is None or sheet_field_name not in data_dict:
+        return None
+        
+    field_value = data_dict[sheet_field_name]
+    for transform in fill_plan['transforms'].get(field_name, ()):
+        field_value = transform(field_value)
+    return field_value
+
+def collect_field_values(fill_plan, data_dict):
+    """
+    Значения полей PDF одного документа {поле PDF: значение} по плану заполнения
+    """
+    values = {}
+    for field_name in fill_plan['fields']:
+        field_value = resolve_field_value(fill_plan, field_name, data_dict)
+        if field_value is not None:
+            values[field_name] = field_value
+    return values
+
+def button_state(widget, value):
+    """
+    Состояние кнопки (/Yes, /Off, имя варианта) для значения из анкеты.
+    Флажок отмечается любым значением из CHECKBOX_TRUE_VALUES или именем
+    своего состояния; переключатель - именем одного из вариантов.
+    """
+    value = str(value).strip()
+    states = widget['states']
+    state = value if value.startswith('/') else '/' + value
+    if state in states:
+        return state
+    if not widget['flags'] & RADIO_FIELD_FLAG and states and value.lower() in CHECKBOX_TRUE_VALUES:
+        return states[0]
+    return '/Off'
+
+def can_generate_appearance(value):
+    """
+    Может ли pypdf сгенерировать вид поля со значением value: стандартные
+    шрифты форм (Helv и т.п.) кодируют только WinAnsi, остальные символы
+    (например, кириллица) в сгенерированном виде превращаются в '?'
+    """
     try:
-        results = drive_service.files().list(
-            q=f"'{folder_id}' in parents and mimeType='application/pdf'",
-            fields="files(id, name)"
-        ).execute()
-        
-        items = results.get('files', [])
-        return items
-    except Exception as e:
-        print(f"Ошибка при получении файлов из папки: {e}")
-        return []
+        value.encode('cp1252')
+        return True
+    except UnicodeEncodeError:
+        return False
 
-def check_folder_exists_by_name(folder_name, parent_folder_id=None):
+def write_field_values(pdf_writer, values, fill_plan):
     """
-    Проверяет, существует ли папка с заданным именем в Google Drive.
+    Записывает значения полей {поле PDF: значение} в форму. Виджеты находятся
+    по индексу из плана заполнения, без сканирования страниц. Поле, значение
+    которого уже совпадает с записанным, не трогается; у кнопок
+    переключается состояние /AS.
 
-    Args:
-        folder_name (str): Имя папки для поиска.
-        parent_folder_id (str, optional): ID родительской папки для поиска.
-                                          Если None, поиск идет по всему диску.
+    Вид (appearance stream) текстовых полей и списков генерирует pypdf -
+    одним вызовом update_page_form_field_values на страницу и только для
+    значений, которые стандартные шрифты форм могут отобразить (см.
+    can_generate_appearance). Остальным значениям записывается только /V:
+    при изменении текстовых полей выставляется /NeedAppearances, и
+    просмотрщик рисует поле сам. Вид с прежним значением у таких полей
+    удаляется, чтобы просмотрщик без поддержки флага не показывал старое.
 
     Returns:
-        
-               - Второй элемент: словарь с данными первой найденной папки
-                                 (если папка найдена) или None.
+        int: число измененных полей.
     """
-    # Формируем поисковый запрос: имя + тип "папка" + не в корзине
-    query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    
-    # Если указана родительская папка, добавляем условие
-    if parent_folder_id:
-        query += f" and '{parent_folder_id}' in parents"
+    from pypdf.generic import NameObject, TextStringObject
     
-    try:
-        # Выполняем поиск
-        results = drive_service.files().list(
-            q=query,
-            spaces='drive',
-            fields='files(id, name, mimeType, webViewLink)',
-            pageSize=10
-        ).execute()
-        
-        folders = results.get('files', [])
+    changed = 0
+    text_changed = False
+    page_values = {}
+    for field_name, field_value in values.items():
+        widget = fill_plan['widgets'].get(field_name)
+        if widget is None:
+            continue
+            
+        annotations = [pdf_writer.pages[page_index]['/Annots'][annot_index].get_object()
+                       for page_index, annot_index in widget['locations']]
+        field = annotations[0] if '/T' in annotations[0] else annotations[0]['/Parent'].get_object()
         
-        if folders:
-            # Папка найдена (берем первую, если есть несколько с одинаковым именем)
-            return folders[0].get('id')
-        else:
-            # Папка не найдена
-            return None
+        if widget['type'] == '/Btn':
+            state = button_state(widget, field_value)
+            if field.get('/V') == state:
+                continue
+            field[NameObject('/V')] = NameObject(state)
+            for annotation in annotations:
+                on_state = state if state in annotation.get('/AP', {}).get('/N', {}) else '/Off'
+                annotation[NameObject('/AS')] = NameObject(on_state)
+            changed += 1
+            continue
             
-    except Exception as error:
-        print(f"Произошла ошибка при обращении к Drive API: {error}")
-        return None
-
-# Функция для создания подпапки для заявителя в Google Drive
-def create_applicant_folder(folder_name, parent_folder_id):
-    try:
-        file_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [parent_folder_id]
-        }
+        field_value = str(field_value)
+        previous_value = str(field.get('/V', ''))
+        if previous_value == field_value:
+            continue
+        if can_generate_appearance(field_value):
+            for page_index, _ in widget['locations']:
+                page_values.setdefault(page_index, {})[field_name] = field_value
+        else:
+            field[NameObject('/V')] = TextStringObject(field_value)
+            if previous_value:
+                for annotation in annotations:
+                    annotation.pop('/AP', None)
+        changed += 1
+        text_changed = True
         
-        folder_id = check_folder_exists_by_name(folder_name, parent_folder_id)
-        if folder_id == None:
-            if DEBUG_INFO: print (f"Папка не существует. Создаем")
-            folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-            folder_id = folder.get('id')
-        return folder_id
-    except Exception as e:
-        print(f"Ошибка при создании папки для {folder_name}: {e}")
-        return None
+    for page_index, page_fields in page_values.items():
+        pdf_writer.update_page_form_field_values(pdf_writer.pages[page_index], page_fields, auto_regenerate=None)
+        
+    if text_changed:
+        pdf_writer.set_need_appearances_writer(True)
+    return changed
 
-# Функция для скачивания файла с Google Drive
-def download_file(file_id, destination):
+# Функция для заполнения PDF формы
+def fill_pdf_form(template_path, output_path, data_dict, mapping, template_name, fill_plan=None, template_cache=None):
     try:
-        request = drive_service.files().get_media(fileId=file_id)
-        with open(destination, 'wb') as f:
-            # Используем MediaIoBaseDownload для потокового скачивания
-            downloader = MediaIoBaseDownload(f, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+        if template_cache is not None:
+            # Клон уже разобранного шаблона из кэша - без чтения файла
+            pdf_writer = template_cache.get_writer(os.path.basename(template_path), template_path)
+        else:
+            from pypdf import PdfReader, PdfWriter
+            with open(template_path, 'rb') as template_file:
+                pdf_reader = PdfReader(template_file)
+                pdf_writer = PdfWriter(clone_from=pdf_reader)
+
+        print (f"Open and clone")
+
+        # Копируем страницы из оригинала
+        #for page_num in range(len(pdf_reader.pages)):
+        #    page = pdf_reader.pages[page_num]
+        #    pdf_writer.add_page(page)
+        #pdf_writer.append(pdf_reader)
+
+        #print (f"Copy")
+
+        # План заполнения обычно скомпилирован заранее; если нет - строим по маппингу
+        # шаблона. Поля берутся из индекса виджетов, а не из get_fields(): тот
+        # обходит все дерево полей заново на каждом документе
+        if fill_plan is None:
+            widgets = index_form_widgets(pdf_writer)
+            fill_plan = compile_fill_plan(mapping.get(template_name, {}), list(widgets), widgets=widgets)
+
+        if fill_plan['fields']:
+            print(f"Найдено полей: {len(fill_plan['fields'])}")
+            values = collect_field_values(fill_plan, data_dict)
+            if DEBUG_INFO:
+                print("Список полей и их текущие значения (если доступны):")
+                for field_name in fill_plan['fields']:
+                    field_value = values.get(field_name)
+                    widget = fill_plan['widgets'].get(field_name)
+                    if field_value is None and widget is not None:
+                        page_index, annot_index = widget['locations'][0]
+                        annotation = pdf_writer.pages[page_index]['/Annots'][annot_index].get_object()
+                        field = annotation if '/T' in annotation else annotation['/Parent'].get_object()
+                        field_value = field.get('/V', 'не заполнено')
+                    print(f"  - Имя: '{field_name}', Текущее значение: {field_value}")
+
+            # Записываем значения всех полей документа одним проходом
+            changed = write_field_values(pdf_writer, values, fill_plan)
+            if DEBUG_INFO: print(f"Записано полей: {changed}")
+
+        else:
+            print("Не удалось получить список полей. ")
+            # restore_acroform_from_annotations(template_file, 'PDF_Restored.pdf')
+            # sys.exit()
+
+        if hasattr(output_path, 'write'):
+            # Запись в буфер в памяти
+            pdf_writer.write(output_path)
+        else:
+            with open(output_path, 'wb') as output_file:
+                pdf_writer.write(output_file)
+            
         return True
     except Exception as e:
-        print(f"Ошибка при скачивании файла: {e}")
+        print(f"Ошибка при заполнении PDF формы: {e}")
         return False
 
-# Функция для загрузки PDF в Google Drive
-def upload_pdf_to_drive(file_path, folder_id, file_name):
+def update_pdf_form_incremental(previous_path, output, data_dict, fill_plan):
+    """
+    Обновляет ранее сформированную форму: меняются только поля, значения
+    которых отличаются от записанных, и изменения дописываются в конец файла
+    инкрементальной секцией. Страницы, потоки содержимого и изображения
+    не переписываются.
+
+    Returns:
+        int: число измененных полей (None при ошибке).
+    """
     try:
-        file_metadata = {
-            'name': file_name,
-            'parents': [folder_id]
-        }
-        media = MediaFileUpload(file_path, mimetype='application/pdf')
-        file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-        return file.get('id')
+        from pypdf import PdfWriter
+        with open(previous_path, 'rb') as previous_file:
+            previous_data = previous_file.read()
+        pdf_writer = PdfWriter(BytesIO(previous_data), incremental=True)
+        changed = write_field_values(pdf_writer, collect_field_values(fill_plan, data_dict), fill_plan)
+        if not changed:
+            # Данные изменились, но значения полей формы - нет
+            output.write(previous_data)
+            return 0
+            
+        if DEBUG_INFO: print(f"Изменено полей: {changed}")
+        pdf_writer.write(output)
+        return changed
     except Exception as e:
-        print(f"Ошибка при загрузке файла: {e}")
+        print(f"Ошибка при обновлении PDF формы: {e}")
         return None
 
-# Функция для заполнения PDF формы
-def fill_pdf_form(template_path, output_path, data_dict, mapping, template_name):
-    try:
-        with open(template_path, 'rb') as template_file:
-            pdf_reader = PdfReader(template_file)
-            pdf_writer = PdfWriter(clone_from=pdf_reader)
-
-            print (f"Open and clone")
+def get_fill_plan(fill_plans, template_cache, mapping, template_name, template_path, mapping_key):
+    """
+    Возвращает план заполнения для пары шаблон/маппинг, компилируя его при первом обращении
+    """
+    plan_key = (template_name, mapping_key)
+    if plan_key not in fill_plans:
+        fill_plans[plan_key] = compile_fill_plan(mapping[mapping_key], read_template_fields(template_path, template_cache),
+                                                 widgets=read_template_widgets(template_path, template_cache))
+    return fill_plans[plan_key]
 
-            # Копируем страницы из оригинала
-            #for page_num in range(len(pdf_reader.pages)):
-            #    page = pdf_reader.pages[page_num]
-            #    pdf_writer.add_page(page)
-            #pdf_writer.append(pdf_reader)
+# Состояние процесса заполнения: маппинг, кэш шаблонов, планы и буфер вывода (см. init_fill_worker)
+_fill_context = {}
 
-            #print (f"Copy")
+def init_fill_worker(mapping):
+    """
+    Инициализирует процесс заполнения. В каждом процессе пула свой кэш
+    шаблонов, поэтому шаблон разбирается один раз на процесс, а не на задание.
+    """
+    _fill_context['mapping'] = mapping
+    _fill_context['template_cache'] = TemplateCache()
+    _fill_context['fill_plans'] = {}
+    # Буфер вывода переиспользуется всеми заданиями процесса
+    _fill_context['buffer'] = BytesIO()
 
-            # Получаем соответствие полей для данного шаблона
-            template_mapping = mapping.get(template_name, {})
+def start_fill_pool(workers, mapping):
+    """
+    Пул процессов заполнения на workers процессов (None при workers <= 1 -
+    заполнение идет в потоках конвейера). Процессы запускаются сразу, до
+    старта потоков конвейера, чтобы fork не копировал процесс с занятыми
+    другими потоками блокировками. Пул переиспользуется проходами --watch:
+    кэш разобранных шаблонов в процессах сохраняется, пока не изменились
+    маппинг или шаблоны.
+    """
+    if workers <= 1:
+        return None
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_fill_worker, initargs=(mapping,))
+    executor.submit(os.getpid).result()
+    return executor
 
-            fields = pdf_writer.get_fields()
-            if not fields  == None:
-                print(f"Найдено полей: {len(fields)}")
-                print("Список полей и их текущие значения (если доступны):")
-                for field_name, field_object in fields.items():
-                     # Объект поля может содержать различные атрибуты, например /V (значение)
-                     # Подробнее о структуре поля: https://gitlab.elegosoft.com/elego/PyPDF2/-/blame/219bb09021a1d607803f27eb195354f75dda29fd/PyPDF2/pdf.py [citation:2]
-                    field_value = field_object.get('/V', 'не заполнено')
-                    
-                    
-                    # Ищем, какое поле из анкеты соответствует этому полю PDF
-                    sheet_field_name = None
-                    for sf, pf in template_mapping.items():
-                        if pf == field_name:
-                            sheet_field_name = sf
-                            break
-                    if sheet_field_name and sheet_field_name in data_dict:
-                        field_value = data_dict[sheet_field_name]
-                    print(f"  - Имя: '{field_name}', Текущее значение: {field_value}")
+def run_fill_job(job):
+    """
+    Выполняет одно задание заполнения (заявитель x шаблон). Форма
+    заполняется в буфер в памяти; если в задании указан output_path,
+    результат дополнительно сохраняется на диск (для отладки). Если указан
+    previous_path, обновляется предыдущий результат (см. update_pdf_form_incremental),
+    а при ошибке обновления форма формируется заново из шаблона.
 
-            else:
-                print("Не удалось получить список полей. ")
-                # restore_acroform_from_annotations(template_file, 'PDF_Restored.pdf')
-                # sys.exit()
-
-            # Проходим по всем аннотациям (полям формы) в каждой странице
-            """ for j in range(len(pdf_writer.pages)):
-                page = pdf_writer.pages[j]
-                #  print (f"page {page}")
-
-                if '/Annots' in page:
-                    for annot in page['/Annots']:
-                        if '/T' in annot:
-                            pdf_field_name = annot['/T']
-
-                            print (f"pdf_field_name = {pdf_field_name}")
-                            
-                            # Ищем, какое поле из анкеты соответствует этому полю PDF
-                            sheet_field_name = None
-                            for sf, pf in template_mapping.items():
-                                if pf == pdf_field_name:
-                                    sheet_field_name = sf
-                                    break
-                                    
-                            if sheet_field_name and sheet_field_name in data_dict:
-                                field_value = data_dict[sheet_field_name]
-                                
-                                # Проверка на необходимость извлечения дня из даты
-                                if "#DAY" in template_mapping and template_mapping["#DAY"] == pdf_field_name:
-                                    try:
-                                        # Пытаемся распарсить дату и извлечь день
-                                        date_obj = datetime.strptime(field_value, '%Y-%m-%d')
-                                        field_value = str(date_obj.day)
-                                    except ValueError:
-                                        # Если не получается, оставляем как есть
-                                        pass
-                                        
-                                # Устанавливаем значение поля
-                                 annot.update({
-                                    PdfWriter..generic.NameObject('/V'): PyPDF.generic.TextStringObject(field_value)
-                                }) """
-
-        with open(output_path, 'wb') as output_file:
-            pdf_writer.write(output_file)
+    Returns:
+        tuple: (успех, текст ошибки или None, байты PDF или None, время заполнения в секундах)
+    """
+    started = time.perf_counter()
+    try:
+        fill_plan = get_fill_plan(
+            _fill_context['fill_plans'], _fill_context['template_cache'], _fill_context['mapping'],
+            job['template_name'], job['template_path'], job['mapping_key']
+        )
+        buffer = _fill_context['buffer']
+        buffer.seek(0)
+        buffer.truncate()
+        if job.get('previous_path'):
+            if update_pdf_form_incremental(job['previous_path'], buffer, job['data'], fill_plan) is None:
+                buffer.seek(0)
+                buffer.truncate()
+                job = dict(job, previous_path=None)
+        if not job.get('previous_path') and not fill_pdf_form(job['template_path'], buffer, job['data'], _fill_context['mapping'],
+                             job['mapping_key'], fill_plan, _fill_context['template_cache']):
+            return False, f"Ошибка при заполнении шаблона {job['template_name']} для {job['surname']}.", None, time.perf_counter() - started
             
-        return True
+        pdf_data = buffer.getvalue()
+        if job.get('output_path'):
+            with open(job['output_path'], 'wb') as output_file:
+                output_file.write(pdf_data)
+        return True, None, pdf_data, time.perf_counter() - started
     except Exception as e:
-        print(f"Ошибка при заполнении PDF формы: {e}")
-        return False
+        return False, f"Ошибка при заполнении шаблона {job['template_name']} для {job['surname']}: {e}", None, time.perf_counter() - started
+
+def print_run_summary(summary):
+    """
+    Выводит итог запуска
+    """
+    print("Итог обработки:")
+    print(f"  Заявителей: {summary['applicants']}, пропущено: {summary['skipped_applicants']}")
+    print(f"  Без изменений (пропущено по манифесту): {summary['unchanged']}")
+    print(f"  Заполнено форм: {summary['filled']}, ошибок заполнения: {summary['fill_errors']}")
+    print(f"  Обновлено инкрементально: {summary['incremental']}, без изменений значений: {summary['same_output']}")
+    print(f"  Загружено файлов: {summary['uploaded']}, ошибок загрузки: {summary['upload_errors']}")
+    for api, stats in api_stats.items():
+        print(f"  {api}: запросов {stats['calls']}, ограничено квотой {stats['throttled']}, "
+              f"повторов {stats['retried']}, ошибок {stats['failed']}")
+
+# Правила валидации собираются один раз при импорте модуля
+CYRILLIC_RE = re.compile('[а-яёА-ЯЁ]')
+
+# Категории правил и ключевые слова в названии поля, по которым поле к ним относится
+VALIDATION_RULE_KEYWORDS = (
+    ('latin_only', ('code', 'number', 'номер', 'код', 'id', 'identifier')),
+    ('gender', ('пол', 'gender', 'sex')),
+    ('marital_status', ('семейное положение', 'marital', 'статус', 'status')),
+    ('nationality', ('гражданство', 'национальность', 'citizenship', 'nationality')),
+)
+
+# Допустимые значения (в нижнем регистре) для категорий с закрытым списком
+VALID_VALUES = {
+    'gender': ('муж', 'жен', 'male', 'female', 'м', 'ж'),
+    'marital_status': ('холост', 'замужем', 'женат', 'разведен', 'вдовец', 'вдова',
+                       'single', 'married', 'divorced', 'widower', 'widow'),
+    'nationality': ('российская', 'русская', 'russian', 'испанская', 'spanish',
+                    'украинская', 'украинец', 'украинка', 'ukrainian'),
+}
+VALID_VALUE_SETS = {category: frozenset(values) for category, values in VALID_VALUES.items()}
+
+
+@lru_cache(maxsize=None)
+def classify_field(field_name):
+    """
+    Категории правил для поля анкеты (в порядке проверки). Названия полей
+    повторяются у всех заявителей, поэтому результат кэшируется на весь запуск.
+    """
+    field_name_lower = field_name.lower()
+    return tuple(category for category, keywords in VALIDATION_RULE_KEYWORDS
+                 if any(keyword in field_name_lower for keyword in keywords))
+
 
 class FormValidator:
     """
@@ -297,13 +1942,7 @@ class FormValidator:
     """
     def __init__(self):
         # Словарь с допустимыми значениями для различных полей
-        self.valid_values = {
-            'gender': ['муж', 'жен', 'male', 'female', 'м', 'ж'],
-            'marital_status': ['холост', 'замужем', 'женат', 'разведен', 'вдовец', 'вдова',
-                             'single', 'married', 'divorced', 'widower', 'widow'],
-            'nationality': ['российская', 'русская', 'russian', 'испанская', 'spanish',
-                          'украинская', 'украинец', 'украинка', 'ukrainian']
-        }
+        self.valid_values = VALID_VALUES
         
     def is_russian_text(self, text):
         """
@@ -312,8 +1951,7 @@ class FormValidator:
         if not text:
             return False
             
-        russian_chars = set('абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ')
-        return any(char in russian_chars for char in str(text))
+        return CYRILLIC_RE.search(str(text)) is not None
     
     def validate_field(self, field_name, field_value, field_type=None):
         """
@@ -322,27 +1960,19 @@ class FormValidator:
         if not field_value:
             return True, "Поле пустое - пропускаем валидацию"
             
-        field_name_lower = field_name.lower()
-        
-        # Проверка на русский текст в полях, где он не допустим
-        if any(keyword in field_name_lower for keyword in ['code', 'number', 'номер', 'код', 'id', 'identifier']):
-            if self.is_russian_text(field_value):
-                return False, f"Поле '{field_name}' содержит русский текст, но должно содержать только цифры или латинские буквы"
-                
-        # Проверка пола
-        if any(keyword in field_name_lower for keyword in ['пол', 'gender', 'sex']):
-            if field_value.lower() not in self.valid_values['gender']:
-                return False, f"Некорректное значение поля '{field_name}': '{field_value}'. Допустимые значения: {', '.join(self.valid_values['gender'])}"
-                
-        # Проверка семейного положения
-        if any(keyword in field_name_lower for keyword in ['семейное положение', 'marital', 'статус', 'status']):
-            if field_value.lower() not in self.valid_values['marital_status']:
-                return False, f"Некорректное значение поля '{field_name}': '{field_value}'. Допустимые значения: {', '.join(self.valid_values['marital_status'])}"
+        value_lower = None
+        for category in classify_field(field_name):
+            # Проверка на русский текст в полях, где он не допустим
+            if category == 'latin_only':
+                if self.is_russian_text(field_value):
+                    return False, f"Поле '{field_name}' содержит русский текст, но должно содержать только цифры или латинские буквы"
+                continue
                 
-        # Проверка гражданства
-        if any(keyword in field_name_lower for keyword in ['гражданство', 'национальность', 'citizenship', 'nationality']):
-            if field_value.lower() not in self.valid_values['nationality']:
-                return False, f"Некорректное значение поля '{field_name}': '{field_value}'. Допустимые значения: {', '.join(self.valid_values['nationality'])}"
+            # Проверка пола, семейного положения и гражданства по списку значений
+            if value_lower is None:
+                value_lower = field_value.lower()
+            if value_lower not in VALID_VALUE_SETS[category]:
+                return False, f"Некорректное значение поля '{field_name}': '{field_value}'. Допустимые значения: {', '.join(self.valid_values[category])}"
                 
         return True, "Поле валидно"
     
@@ -370,128 +2000,566 @@ class FormValidator:
                 warnings.append(f"{field_name}: {message}")
                 
         return len(errors) == 0, errors, warnings
-
-# Основная логика программы
-if __name__ == '__main__':
-    # Получение маппинга полей
-    mapping = get_mapping()
-    if not mapping:
-        print("Не удалось получить маппинг полей. Завершение работы.")
-        exit()
-        
-    print(f"Получено маппингов для шаблонов: {list(mapping.keys())}")
     
-    # Получение списка шаблонов PDF из папки на Google Drive
-    filtered_templates = []
-    template_files = list_files_in_folder(PDF_TEMPLATES_FOLDER_ID)
-    if not template_files:
-        print("Не найдено шаблонов PDF. Завершение работы.")
-        exit()
-    else:
-        print(f"Найдено шаблонов PDF: {len(template_files)}")
-        for tmpl in template_files:
-            print (f"Шаблон - {tmpl['name']}")
-            if tmpl['name'] in list(mapping.keys()):
-                filtered_templates.append(tmpl)
-            else:
-                print (f"Не берем этот шаблон - его нет в Mapping")
-        pass
-    # подменим на очищенный список шаблонов для обработки
-    template_files = filtered_templates
+    def validate_batch(self, applicants, required_fields=None):
+        """
+        Валидирует всех заявителей за один вызов
         
-    # Создаем временные папки
-    os.makedirs('templates', exist_ok=True)
-    os.makedirs('filled_forms', exist_ok=True)
+        Args:
+            applicants (dict): {фамилия: данные анкеты}.
+            required_fields (list, optional): обязательные поля анкеты.
+            
+        Returns:
+            dict: {фамилия: (валидны ли данные, ошибки, предупреждения)}
+        """
+        return {surname: self.validate_applicant_data(data_dict, required_fields)
+                for surname, data_dict in applicants.items()}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Заполнение PDF-анкет заявителей по данным Google Sheets')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='число процессов для заполнения PDF (по умолчанию 1 - без пула)')
+    parser.add_argument('--folder-workers', type=int, default=FOLDER_WORKERS,
+                        help=f'число потоков поиска и создания папок заявителей (по умолчанию {FOLDER_WORKERS})')
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS,
+                        help=f'число потоков загрузки результатов на Drive (по умолчанию {UPLOAD_WORKERS})')
+    parser.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE,
+                        help=f'емкость очередей между этапами конвейера (по умолчанию {PIPELINE_QUEUE_SIZE})')
+    parser.add_argument('--save-local', action='store_true',
+                        help='дополнительно сохранять заполненные формы в filled_forms/ (для отладки)')
+    parser.add_argument('--local', metavar='DIR',
+                        help='работать с локальным каталогом вместо Google Sheets/Drive (см. local_backend.py)')
+    parser.add_argument('--metrics-json', default=METRICS_JSON_PATH, metavar='PATH',
+                        help=f'куда записать JSON-сводку метрик запуска (по умолчанию {METRICS_JSON_PATH})')
+    parser.add_argument('--metrics-prom', default=METRICS_PROM_PATH, metavar='PATH',
+                        help=f'куда записать метрики для Prometheus textfile collector (по умолчанию {METRICS_PROM_PATH})')
+    parser.add_argument('--repair', nargs=2, metavar=('INPUT', 'OUTPUT'),
+                        help='восстановить /AcroForm шаблона по аннотациям (PDFRepair) и завершить работу')
+    parser.add_argument('--analyze', metavar='PDF',
+                        help='вывести анализ структуры PDF (PDFRepair) и завершить работу; для каталога - '
+                             'проанализировать все PDF в нем и записать JSON-отчет (см. --analyze-report)')
+    parser.add_argument('--analyze-report', default='pdf_analysis.json', metavar='PATH',
+                        help='куда записать JSON-отчет --analyze по каталогу (по умолчанию pdf_analysis.json)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='при изменении только данных анкеты дописывать в предыдущий результат '
+                             'измененные значения полей вместо полной перезаписи')
+    parser.add_argument('--watch', action='store_true',
+                        help='после прохода следить за изменениями на Drive и формировать затронутые формы')
+    parser.add_argument('--watch-interval', type=float, default=WATCH_POLL_SECONDS, metavar='SECONDS',
+                        help=f'период опроса ленты изменений в режиме --watch (по умолчанию {WATCH_POLL_SECONDS})')
+    parser.add_argument('--force', action='store_true',
+                        help='заполнить и загрузить все формы, не сверяясь с манифестом')
+    parser.add_argument('--fuzzy-mapping', action='store_true',
+                        help='брать и шаблоны без колонки Mapping с точно таким же именем: колонку '
+                             'искать без расширения, без учета регистра и по вхождению имени')
+    return parser.parse_args(argv)
+
+def load_templates(mapping, metrics, fuzzy=False):
+    """
+    Листинг шаблонов PDF из папки на Google Drive идет постранично: шаблоны из
+    Mapping отбираются и новые/измененные скачиваются по мере получения страниц.
+    Колонка маппинга для каждого шаблона выбирается здесь один раз на весь запуск
+    (fuzzy - нечеткое совпадение имен, см. resolve_mapping_key).
+
+    Если листинг прервался ошибкой, шаблоны из неполного списка не
+    используются, а индекс локального кэша не перезаписывается (см. sync_templates).
+
+    Returns:
+        tuple: (имя шаблона -> локальный путь, имя шаблона -> ключ маппинга,
+                все найденные в папке файлы) или None, если список получить не удалось.
+    """
+    listed_templates = []
+    template_mapping_keys = {}
+    template_stats = {}
+    with metrics.stage('templates'):
+        try:
+            template_paths = sync_templates(
+                filter_mapped_templates(iter_files_in_folder(PDF_TEMPLATES_FOLDER_ID), mapping, listed_templates,
+                                        template_mapping_keys, fuzzy),
+                stats=template_stats
+            )
+        except Exception as e:
+            print(f"Ошибка при получении списка шаблонов: {e}")
+            return None
+    metrics.add('templates', items=len(template_paths), bytes=template_stats.get('downloaded_bytes', 0))
+    return template_paths, template_mapping_keys, listed_templates
+
+def process_applicants(args, mapping, template_paths, template_mapping_keys, manifest, metrics, executor=None):
+    """
+    Один проход по заявителям - потоковый конвейер этапов (см. run_pipeline):
     
-    # Скачиваем шаблоны
-    template_paths = {}
-    for file in template_files:
-        template_name = file['name']
-        if template_name.endswith('.pdf'):
-            local_path = os.path.join('templates', template_name)
-            if download_file(file['id'], local_path):
-                template_paths[template_name] = local_path
-                
-    if not template_paths:
-        print("Не удалось скачать ни одного шаблона. Завершение работы.")
-        exit()
-        
-    # Получение списка вкладок из файла Clients_for_PDF (предполагается, что есть способ получить список листов)
-    try:
-        spreadsheet = sheets_service.spreadsheets().get(spreadsheetId=CLIENTS_SPREADSHEET_ID, includeGridData=False).execute()
-        sheets = spreadsheet.get('sheets', [])
-        
-        # Создаем валидатор
-        validator = FormValidator()
-        
-        for sheet in sheets:
-            surname = sheet['properties']['title']
+      чтение анкет (группами batchGet) -> валидация и задания на заполнение
+      (формы с неизменившимися входами пропускаются по манифесту) -> папки
+      заявителей -> заполнение -> загрузка.
+    
+    Этапы работают одновременно и связаны ограниченными очередями: пока
+    заполняются формы первой группы, читается следующая, а готовые формы
+    уже загружаются. Заполнение идет в пуле процессов executor (см.
+    start_fill_pool; без пула - в args.workers потоках), папки - в
+    args.folder_workers потоках, загрузка - в args.upload_workers потоках
+    (HTTP-транспорты API общие, из пула, см. ClientPool). Чтение анкет и
+    валидация идут в одном потоке каждое: чтение - последовательные запросы
+    batchGet по группам вкладок, валидация - короткая работа на CPU, которую
+    потоки под GIL не ускорят. Манифест обновляется по мере загрузки.
+
+    Returns:
+        dict: счетчики итога (см. print_run_summary).
+    """
+    with metrics.stage('applicant_fetch'):
+        surnames = get_applicant_tabs()
+        if surnames is None:
+            surnames = []
+            
+    # Создаем валидатор
+    validator = FormValidator()
+    
+    # Счетчики итога и манифест обновляются из потоков этапов
+    summary = {'applicants': len(surnames), 'skipped_applicants': 0,
+               'unchanged': 0, 'filled': 0, 'fill_errors': 0, 'incremental': 0, 'same_output': 0,
+               'uploaded': 0, 'upload_errors': 0}
+    summary_lock = threading.Lock()
+    
+    def count(key, value=1):
+        with summary_lock:
+            summary[key] += value
+            
+    # Формы, входные данные которых не изменились с прошлого запуска, пропускаем
+    template_hashes = {name: file_hash(path) for name, path in template_paths.items()}
+    mapping_hashes = {key: content_hash(mapping[key]) for key in set(template_mapping_keys.values())}
+    
+    # Серийные номера дат переводятся в даты один раз на заявителя, а не в каждом шаблоне
+    date_fields = mapping_date_fields(mapping)
+    
+    def fetch_applicants():
+        chunks = iter_applicant_chunks(surnames)
+        while True:
+            with metrics.stage('applicant_fetch'):
+                applicants = next(chunks, None)
+            if applicants is None:
+                return
+            metrics.add('applicant_fetch', items=len(applicants))
+            yield applicants
+            
+    def build_jobs(applicants):
+        """
+        Этап валидации: группа анкет -> список заданий (заявитель x шаблон)
+        """
+        started = time.perf_counter()
+        if VALIDATION_ON:
+            # Валидация данных всех анкет группы одним вызовом
+            validation_results = validator.validate_batch(
+                {surname: data for surname, data in applicants.items() if data},
+                required_fields=['Фамилия', 'Имя', 'Дата рождения', 'Пол']  # Пример обязательных полей
+            )
+            
+        fill_jobs = []
+        for surname, applicant_data in applicants.items():
             print(f"Обработка заявителя: {surname}")
             
-            # Получение данных анкеты
-            applicant_data = get_applicant_data(surname)
+            # Данные анкеты уже получены пакетным запросом
             if not applicant_data:
                 print(f"Пропуск заявителя {surname} из-за ошибки при получении данных.")
+                count('skipped_applicants')
                 continue
                 
             if VALIDATION_ON:
-                # Валидация данных анкеты
-                is_valid, errors, warnings = validator.validate_applicant_data(
-                    applicant_data,
-                    required_fields=['Фамилия', 'Имя', 'Дата рождения', 'Пол']  # Пример обязательных полей
-                )
+                is_valid, errors, warnings = validation_results[surname]
                 
                 if not is_valid:
                     print(f"Ошибки валидации для {surname}:")
                     for error in errors:
                         print(f"  - {error}")
+                    count('skipped_applicants')
                     continue  # Пропускаем заявителя с ошибками
                 
                 if warnings:
                     print(f"Предупреждения для {surname}:")
                     for warning in warnings:
                         print(f"  - {warning}")
+                        
+            applicant_data = normalize_serial_dates(applicant_data, date_fields)
+            data_hash = content_hash(applicant_data)
             
-            # Создание папки для заявителя в FilledPDF
-            applicant_folder_id = create_applicant_folder(surname, FILLED_PDF_FOLDER_ID)
-            if not applicant_folder_id:
-                print(f"Пропуск заявителя {surname} из-за ошибки при создании папки.")
-                continue
-                
             # Заполнение каждого шаблона
             for template_name, template_path in template_paths.items():
-                # Определяем имя шаблона без расширения для поиска в маппинге
-                base_template_name = os.path.splitext(template_name)[0]
+                # Колонка маппинга выбрана один раз при отборе шаблонов
+                matching_mapping_key = template_mapping_keys[template_name]
                 
-                # Ищем соответствие в маппинге (может быть не точное совпадение, нужно уточнить логику)
-                matching_mapping_key = None
-                for key in mapping.keys():
-                    if base_template_name.lower() in key.lower() or key.lower() in base_template_name.lower():
-                        matching_mapping_key = key
-                        break
-                        
-                if not matching_mapping_key:
-                    print(f"Для шаблона {template_name} не найдено соответствия в маппинге. Пропуск.")
+                output_key = manifest_key(surname, template_name)
+                input_hashes = {
+                    'data': data_hash,
+                    'mapping': mapping_hashes[matching_mapping_key],
+                    'template': template_hashes[template_name],
+                }
+                with summary_lock:
+                    entry = manifest.get(output_key, {})
+                    current = is_output_current(manifest, output_key, input_hashes)
+                    incremental = args.incremental and can_update_incrementally(manifest, output_key, input_hashes)
+                if not args.force and current:
+                    count('unchanged')
                     continue
                     
-                # Формируем имя выходного файла
+                # Формируем имя выходного файла; на диск результат пишется только с --save-local
                 output_filename = f"{surname}_{template_name}"
-                output_path = os.path.join('filled_forms', output_filename)
+                output_path = os.path.join('filled_forms', output_filename) if args.save_local else None
+                
+                fill_jobs.append({
+                    'surname': surname,
+                    'data': applicant_data,
+                    'template_name': template_name,
+                    'template_path': template_path,
+                    'mapping_key': matching_mapping_key,
+                    'output_path': output_path,
+                    'output_filename': output_filename,
+                    'manifest_key': output_key,
+                    'input_hashes': input_hashes,
+                    'file_id': entry.get('file_id'),
+                    # Хэш предыдущего результата - только если его можно обновить инкрементально
+                    'previous_hash': entry['output'] if incremental else None,
+                })
+                
+        metrics.add('validation', seconds=time.perf_counter() - started, items=len(applicants))
+        return [fill_jobs] if fill_jobs else []
+        
+    def prepare_jobs(fill_jobs):
+        """
+        Этап папок: папки в FilledPDF ищутся и создаются пакетными запросами -
+        только для заявителей группы, у которых есть работа
+        """
+        pending_surnames = list(dict.fromkeys(job['surname'] for job in fill_jobs))
+        with metrics.stage('folder_resolution', items=len(pending_surnames)):
+            applicant_folders = resolve_applicant_folders(pending_surnames, FILLED_PDF_FOLDER_ID)
+            
+        for surname in pending_surnames:
+            if not applicant_folders.get(surname):
+                print(f"Пропуск заявителя {surname} из-за ошибки при создании папки.")
+                count('skipped_applicants')
+        fill_jobs = [job for job in fill_jobs if applicant_folders.get(job['surname'])]
+        for job in fill_jobs:
+            job['folder_id'] = applicant_folders[job['surname']]
+            
+        if args.incremental:
+            with metrics.stage('previous_fetch', items=sum(1 for job in fill_jobs if job['previous_hash'])):
+                previous_bytes = fetch_previous_outputs(fill_jobs)
+            metrics.add('previous_fetch', bytes=previous_bytes)
+        return fill_jobs
+        
+    def fill(job):
+        """
+        Этап заполнения: в пуле процессов или, при --workers 1, в потоке этапа
+        """
+        if executor is not None:
+            result = executor.submit(run_fill_job, job).result()
+        else:
+            result = run_fill_job(job)
+        filled, error, pdf_data, fill_seconds = result
+        # Время заполнения замеряется в процессе, который заполнял форму
+        metrics.add('fill', seconds=fill_seconds, items=1, bytes=len(pdf_data or b''), template=job['template_name'])
+        return [(job, result)]
+        
+    def upload(item):
+        """
+        Этап загрузки заполненной формы в папку заявителя
+        """
+        job, (filled, error, pdf_data, fill_seconds) = item
+        output_filename = job['output_filename']
+        if DEBUG_INFO: print(f"Формируем файл {output_filename}")
+        
+        if not filled:
+            print(error)
+            count('fill_errors')
+            return
+        count('filled')
+        if job.get('previous_path'):
+            count('incremental')
+            
+        output_hash = hashlib.sha256(pdf_data).hexdigest()
+        with summary_lock:
+            previous_entry = manifest.get(job['manifest_key'], {})
+            if not args.force and job['file_id'] and previous_entry.get('output') == output_hash:
+                # Значения полей не изменились - файл на Drive уже актуален
+                # (с --force загружаем все равно: файл на Drive могли удалить или испортить)
+                summary['same_output'] += 1
+                manifest[job['manifest_key']] = dict(previous_entry, inputs=job['input_hashes'])
+                return
+                
+        with metrics.stage('upload', template=job['template_name'], items=1, bytes=len(pdf_data)):
+            uploaded_file_id = upload_pdf_to_drive(job['output_path'], job['folder_id'], output_filename, job['file_id'], pdf_data)
+        if uploaded_file_id:
+            print(f"Файл {output_filename} успешно загружен.")
+            with summary_lock:
+                summary['uploaded'] += 1
+                manifest[job['manifest_key']] = {'inputs': job['input_hashes'], 'file_id': uploaded_file_id, 'output': output_hash}
+            if args.incremental:
+                # Копия загруженного файла - основа следующего инкрементального обновления
+                with open(previous_output_path(output_filename), 'wb') as previous_file:
+                    previous_file.write(pdf_data)
+        else:
+            print(f"Ошибка при загрузке файла {output_filename}.")
+            count('upload_errors')
+            
+    if executor is None and _fill_context.get('mapping') is not mapping:
+        # Кэш шаблонов и планы остаются между проходами, пока не сменился маппинг (режим --watch)
+        init_fill_worker(mapping)
+        
+    run_pipeline(fetch_applicants(), [
+        Stage('validation', build_jobs),
+        Stage('folders', prepare_jobs, workers=args.folder_workers),
+        Stage('fill', fill, workers=args.workers),
+        Stage('upload', upload, workers=args.upload_workers),
+    ], queue_size=args.queue_size)
+    return summary
 
-                if DEBUG_INFO: print(f"Формируем файл {output_filename}")
+def get_start_page_token():
+    """
+    Текущая позиция ленты изменений
+    """
+    return backend.get_start_page_token()
+
+def list_changes(page_token):
+    """
+    Изменения файлов, начиная с page_token
+
+    Returns:
+        tuple: (список изменений, позиция для следующего опроса)
+    """
+    return backend.list_changes(page_token)
+
+def classify_changes(changes, template_ids=()):
+    """
+    Что затронули изменения: 'mapping' (файл Mapping), 'clients' (Clients_for_PDF)
+    и 'templates' (файлы папки PDF_templates, в том числе удаленные из нее).
+    Изменения остальных файлов, включая загруженные результаты, не учитываются.
+    """
+    kinds = set()
+    for change in changes:
+        file_id = change.get('fileId')
+        parents = (change.get('file') or {}).get('parents', [])
+        if file_id == MAPPING_SPREADSHEET_ID:
+            kinds.add('mapping')
+        elif file_id == CLIENTS_SPREADSHEET_ID:
+            kinds.add('clients')
+        elif PDF_TEMPLATES_FOLDER_ID in parents or file_id in template_ids:
+            kinds.add('templates')
+    return kinds
+
+def load_watch_state(path=None):
+    return load_json(path or WATCH_STATE_PATH) or {}
+
+def save_watch_state(state, path=None):
+    save_json_atomic(path or WATCH_STATE_PATH, state)
+
+def watch_source():
+    # Позиция ленты изменений относится к конкретному Drive (или локальному каталогу)
+    return backend.source
+
+def run_failed(summary):
+    """
+    Завершился ли проход с ошибками заполнения или загрузки форм
+    """
+    return bool(summary['fill_errors'] or summary['upload_errors'])
+
+def watch_for_changes(args, page_token, mapping, template_paths, template_mapping_keys, listed_templates,
+                      manifest, metrics, executor=None, pending=None):
+    """
+    Режим --watch: опрашивает ленту изменений Drive и при изменении анкет,
+    маппинга или шаблонов повторяет проход по заявителям. Маппинг, шаблоны
+    и кэш разобранных шаблонов остаются в памяти между проходами и
+    обновляются только при изменении своих файлов; HTTP-транспорты API с
+    открытыми соединениями возвращаются в пул и служат следующим проходам
+    (см. ClientPool), хотя потоки этапов каждый проход новые. Формы, входы которых
+    не изменились, пропускаются по манифесту. Пул процессов заполнения
+    executor (см. start_fill_pool) тоже переиспользуется и пересоздается
+    только при смене маппинга или шаблонов. Работает до Ctrl+C.
+    
+    Позиция ленты сохраняется (save_watch_state) только после прохода без
+    ошибок. Если проход упал или часть форм не заполнена/не загружена,
+    затронутые изменения остаются в pending и обрабатываются снова при
+    следующем опросе, а после перезапуска - заново из сохраненной позиции.
+    
+    Args:
+        pending (set, optional): виды изменений (см. classify_changes), которые
+                                 нужно обработать при первом опросе.
+    """
+    pending = set(pending or ())
+    print(f"Ожидание изменений (опрос раз в {args.watch_interval} с, Ctrl+C - выход)...")
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            try:
+                changes, page_token = list_changes(page_token)
+            except Exception as e:
+                print(f"Ошибка при получении изменений Drive: {e}")
+                continue
                 
-                # Заполняем форму
-                if fill_pdf_form(template_path, output_path, applicant_data, mapping, matching_mapping_key):
-                    # Загружаем заполненную форму в папку заявителя
-                    uploaded_file_id = upload_pdf_to_drive(output_path, applicant_folder_id, output_filename)
-                    if uploaded_file_id:
-                        print(f"Файл {output_filename} успешно загружен.")
-                    else:
-                        print(f"Ошибка при загрузке файла {output_filename}.")
+            # Изменения, проход по которым не удался, обрабатываются вместе с новыми
+            kinds = pending | classify_changes(changes, {file['id'] for file in listed_templates})
+            if not kinds:
+                save_watch_state({'source': watch_source(), 'page_token': page_token})
+                continue
+            print(f"Изменения: {', '.join(sorted(kinds))}")
+            
+            failed = set()
+            reload_pool = False
+            if 'mapping' in kinds:
+                with metrics.stage('mapping_load'):
+                    new_mapping = get_mapping()
+                if new_mapping:
+                    mapping = new_mapping
+                    reload_pool = True
+                else:
+                    print("Не удалось обновить маппинг - используется прежний.")
+                    failed.add('mapping')
+                    
+            if kinds & {'mapping', 'templates'}:
+                templates = load_templates(mapping, metrics, args.fuzzy_mapping)
+                if templates and templates[0]:
+                    template_paths, template_mapping_keys, listed_templates = templates
+                    # Шаблоны могли измениться под теми же именами - кэш разобранных шаблонов сбрасывается
+                    _fill_context.clear()
+                    reload_pool = True
                 else:
-                    print(f"Ошибка при заполнении шаблона {template_name} для {surname}.")
+                    print("Не удалось обновить шаблоны - используются прежние.")
+                    failed |= kinds & {'mapping', 'templates'}
                     
+            if reload_pool and executor is not None:
+                # Процессы пула держат прежние маппинг и кэш шаблонов
+                executor.shutdown()
+                executor = start_fill_pool(args.workers, mapping)
+                
+            try:
+                summary = process_applicants(args, mapping, template_paths, template_mapping_keys, manifest, metrics,
+                                             executor)
+                print_run_summary(summary)
+                if run_failed(summary):
+                    failed.add('clients')
+            except Exception as e:
+                print(f"Ошибка при обработке вкладок: {e}")
+                failed.add('clients')
+            save_manifest(manifest)
+            
+            pending = failed
+            if pending:
+                print("Проход завершился с ошибками - он будет повторен при следующем опросе.")
+            else:
+                save_watch_state({'source': watch_source(), 'page_token': page_token})
+            try:
+                metrics.write_json(args.metrics_json)
+                metrics.write_prometheus(args.metrics_prom)
+            except Exception as e:
+                print(f"Ошибка при сохранении метрик: {e}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+# Основная логика программы
+if __name__ == '__main__':
+    args = parse_args()
+    
+    # Разовые операции над PDF - без обращения к Google API
+    if args.repair or args.analyze:
+        from PDFRepair import analyze_pdf_directory, analyze_pdf_structure, restore_acroform_from_annotations
+        if args.analyze and os.path.isdir(args.analyze):
+            summary = analyze_pdf_directory(args.analyze, args.analyze_report)['summary']
+            print(f"Проанализировано PDF: {summary['files']}, с AcroForm: {summary['acroform']}, с XFA: {summary['xfa']}")
+            if summary['broken']:
+                print(f"Признаки поврежденной формы: {', '.join(summary['broken'])}")
+            if summary['errors']:
+                print(f"Ошибки чтения: {', '.join(summary['errors'])}")
+            if summary['not_analyzed']:
+                print(f"Не проанализированы (сжатые объекты не прочитаны): {', '.join(summary['not_analyzed'])}")
+            print(f"Отчет сохранен в {args.analyze_report}")
+        elif args.analyze:
+            analyze_pdf_structure(args.analyze)
+        if args.repair:
+            restore_acroform_from_annotations(*args.repair)
+        sys.exit()
+        
+    if args.local:
+        backend = LocalBackend(args.local, folder_aliases={
+            PDF_TEMPLATES_FOLDER_ID: TEMPLATES_FOLDER,
+            FILLED_PDF_FOLDER_ID: FILLED_FOLDER,
+        }, file_aliases={
+            CLIENTS_SPREADSHEET_ID: CLIENTS_NAME,
+            MAPPING_SPREADSHEET_ID: MAPPING_NAME,
+        })
+        
+    # Метрики по этапам: время, элементы, байты и запросы к API
+    metrics = RunMetrics(api_stats=api_stats)
+    
+    # Получение маппинга полей
+    with metrics.stage('mapping_load'):
+        mapping = get_mapping()
+    if not mapping:
+        print("Не удалось получить маппинг полей. Завершение работы.")
+        exit()
+        
+    print(f"Получено маппингов для шаблонов: {list(mapping.keys())}")
+    metrics.add('mapping_load', items=len(mapping))
+    
+    # Создаем временные папки
+    os.makedirs('templates', exist_ok=True)
+    if args.save_local:
+        os.makedirs('filled_forms', exist_ok=True)
+    
+    templates = load_templates(mapping, metrics, args.fuzzy_mapping)
+    if templates is None:
+        print("Не удалось получить список шаблонов. Завершение работы.")
+        exit()
+    template_paths, template_mapping_keys, listed_templates = templates
+    
+    if not listed_templates:
+        print("Не найдено шаблонов PDF. Завершение работы.")
+        exit()
+    print(f"Найдено шаблонов PDF: {len(listed_templates)}")
+    
+    if not template_paths:
+        print("Не удалось скачать ни одного шаблона. Завершение работы.")
+        exit()
+        
+    print("Шаблоны и колонки Mapping:")
+    for template_name in template_paths:
+        print(f"  {template_name} -> {template_mapping_keys[template_name]}")
+        
+    # Манифест результатов прошлых запусков; сохраняется даже при аварийном завершении
+    manifest = load_manifest()
+    
+    # Получение списка вкладок из файла Clients_for_PDF и данных всех заявителей
+    fill_pool = None
+    try:
+        if args.watch:
+            # Позиция в ленте изменений фиксируется до прохода, чтобы не пропустить
+            # правки, сделанные во время него; при перезапуске берется сохраненная
+            watch_state = load_watch_state()
+            if watch_state.get('source') == watch_source() and watch_state.get('page_token'):
+                page_token = watch_state['page_token']
+            else:
+                page_token = get_start_page_token()
+                save_watch_state({'source': watch_source(), 'page_token': page_token})
+                
+        # Пул процессов заполнения создается один раз и в режиме --watch служит всем проходам
+        fill_pool = start_fill_pool(args.workers, mapping)
+        summary = process_applicants(args, mapping, template_paths, template_mapping_keys, manifest, metrics, fill_pool)
+        print_run_summary(summary)
+        
+        if args.watch:
+            save_manifest(manifest)
+            watch_for_changes(args, page_token, mapping, template_paths, template_mapping_keys, listed_templates,
+                              manifest, metrics, fill_pool, pending={'clients'} if run_failed(summary) else None)
+            
+    except KeyboardInterrupt:
+        print("Остановлено пользователем.")
     except Exception as e:
         print(f"Ошибка при обработке вкладок: {e}")
+    finally:
+        if fill_pool is not None:
+            fill_pool.shutdown()
+        save_manifest(manifest)
+        metrics.finish()
+        try:
+            metrics.write_json(args.metrics_json)
+            metrics.write_prometheus(args.metrics_prom)
+        except Exception as e:
+            print(f"Ошибка при сохранении метрик: {e}")
         
     print('Процесс завершен.')
@@ -0,0 +1,95 @@
+import queue
+import threading
+
+# Маркер конца потока элементов в очереди этапа
+_DONE = object()
+
+
+class Stage:
+    """
+    Этап конвейера: функция func(item) обрабатывает элемент и возвращает
+    итерируемое с элементами для следующего этапа (пусто или None - ничего
+    не передавать). Функция выполняется в workers потоках.
+    """
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+def run_pipeline(source, stages, queue_size=64):
+    """
+    Запускает этапы, соединенные очередями из queue_size элементов. Источник
+    и каждый этап работают в своих потоках одновременно: пока один этап ждет
+    сеть, другой занят вычислениями. Если следующий этап не успевает, очередь
+    заполняется и предыдущий этап ждет (backpressure), поэтому в памяти
+    одновременно не больше queue_size элементов на этап, а пропускная
+    способность определяется самым медленным этапом.
+
+    Первое исключение в любом этапе останавливает конвейер: оставшиеся
+    элементы вычитываются без обработки, и после остановки всех потоков
+    исключение выбрасывается из run_pipeline.
+
+    Args:
+        source (iterable): элементы для первого этапа.
+        stages (list): этапы (Stage) в порядке обработки; результаты последнего
+                       этапа отбрасываются.
+        queue_size (int): емкость очереди перед каждым этапом.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stop = threading.Event()
+    errors = []
+    lock = threading.Lock()
+    finished = [0] * len(stages)
+
+    def fail(error):
+        with lock:
+            errors.append(error)
+        stop.set()
+
+    def feed():
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                queues[0].put(item)
+        except Exception as e:
+            fail(e)
+        finally:
+            queues[0].put(_DONE)
+
+    def work(index):
+        stage = stages[index]
+        input_queue = queues[index]
+        output_queue = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                # Маркер возвращается в очередь для остальных потоков этапа
+                input_queue.put(_DONE)
+                break
+            if stop.is_set():
+                continue
+            try:
+                for result in stage.func(item) or ():
+                    if output_queue is not None:
+                        output_queue.put(result)
+            except Exception as e:
+                fail(e)
+        with lock:
+            finished[index] += 1
+            last = finished[index] == stage.workers
+        if last and output_queue is not None:
+            output_queue.put(_DONE)
+
+    threads = [threading.Thread(target=feed, name='pipeline-source', daemon=True)]
+    for index, stage in enumerate(stages):
+        for worker in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(index,), name=f"pipeline-{stage.name}-{worker}", daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
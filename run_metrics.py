@@ -0,0 +1,167 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from json_files import save_json_atomic, write_atomic
+
+# Префикс метрик в textfile для Prometheus (node_exporter textfile collector)
+METRIC_PREFIX = 'pdf_filler'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StageTag:
+    """
+    Счетчик запросов к API одного замера RunMetrics.stage. Запросы относятся
+    к замеру потока, который их сделал, и ко всем объемлющим замерам (parent).
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.api_calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.api_calls += count
+
+
+# Замер, который сейчас идет в потоке: параллельные этапы конвейера работают
+# в разных потоках и не получают запросы друг друга
+_thread_stage = threading.local()
+
+
+def current_stage():
+    """
+    Замер (StageTag), идущий в текущем потоке, или None
+    """
+    return getattr(_thread_stage, 'tag', None)
+
+
+def adopt_stage(tag):
+    """
+    Относит запросы текущего потока к замеру tag. Для пулов потоков, которые
+    этап запускает внутри замера: ThreadPoolExecutor(initializer=adopt_stage,
+    initargs=(current_stage(),))
+    """
+    _thread_stage.tag = tag
+
+
+def count_api_calls(count=1):
+    """
+    Учитывает count запросов к API в замере текущего потока
+    """
+    tag = current_stage()
+    while tag is not None:
+        tag.add(count)
+        tag = tag.parent
+
+
+class RunMetrics:
+    """
+    Метрики одного запуска по этапам конвейера: время, число элементов,
+    переданные байты и число запросов к API - в целом по этапу и по шаблонам.
+    """
+    FIELDS = ('seconds', 'items', 'bytes', 'api_calls')
+
+    def __init__(self, api_stats=None):
+        """
+        Args:
+            api_stats (dict, optional): счетчики API, попадают в итог как есть.
+        """
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stages = {}
+        self._api_stats = api_stats
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, items=0, bytes=0, api_calls=0, template=None):
+        """
+        Добавляет значения к этапу stage (и к шаблону template внутри этапа)
+        """
+        values = {'seconds': seconds, 'items': items, 'bytes': bytes, 'api_calls': api_calls}
+        with self._lock:
+            entry = self.stages.setdefault(stage, dict(dict.fromkeys(self.FIELDS, 0), templates={}))
+            targets = [entry]
+            if template is not None:
+                targets.append(entry['templates'].setdefault(template, dict.fromkeys(self.FIELDS, 0)))
+            for target in targets:
+                for key, value in values.items():
+                    target[key] += value
+
+    @contextmanager
+    def stage(self, stage, template=None, items=0, bytes=0):
+        """
+        Замеряет время блока и число запросов к API, сделанных в нем: запросы
+        учитывает count_api_calls в потоке, выполняющем блок (и в пулах,
+        принявших замер через adopt_stage).
+        """
+        tag = StageTag(parent=current_stage())
+        adopt_stage(tag)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            adopt_stage(tag.parent)
+            self.add(stage, seconds=time.perf_counter() - started, items=items, bytes=bytes,
+                     api_calls=tag.api_calls, template=template)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        finished_at = self.finished_at or time.time()
+        return {
+            'started_at': self.started_at,
+            'finished_at': finished_at,
+            'wall_seconds': finished_at - self.started_at,
+            'stages': self.stages,
+            'api': self._api_stats or {},
+        }
+
+    def write_json(self, path):
+        save_json_atomic(path, self.to_dict())
+
+    def to_prometheus(self):
+        summary = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            full_name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} gauge")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{full_name}{{{label_text}}} {value}" if label_text else f"{full_name} {value}")
+
+        metric('run_start_timestamp_seconds', 'Unix time the run started', [({}, summary['started_at'])])
+        metric('run_wall_seconds', 'Total wall time of the run', [({}, summary['wall_seconds'])])
+
+        help_texts = {
+            'seconds': 'Time spent in a pipeline stage',
+            'items': 'Items processed by a pipeline stage',
+            'bytes': 'Bytes transferred by a pipeline stage',
+            'api_calls': 'Google API requests made by a pipeline stage',
+        }
+        # Значения по шаблонам - отдельные метрики: сумма stage_* по всем меткам
+        # не должна складывать этап с его же разбивкой по шаблонам
+        for field, help_text in help_texts.items():
+            metric(f"stage_{field}", help_text,
+                   [({'stage': stage}, entry[field]) for stage, entry in summary['stages'].items()])
+            metric(f"stage_template_{field}", f"{help_text}, per template",
+                   [({'stage': stage, 'template': template}, template_entry[field])
+                    for stage, entry in summary['stages'].items()
+                    for template, template_entry in entry['templates'].items()])
+
+        samples = []
+        for api, stats in summary['api'].items():
+            for event, value in stats.items():
+                samples.append(({'api': api, 'event': event}, value))
+        metric('api_requests', 'Google API requests by outcome', samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # textfile collector может прочитать файл в момент записи - пишем через rename
+        write_atomic(path, self.to_prometheus())